@@ -17,21 +17,22 @@ wget https://raw.githubusercontent.com/Change-Goose-Open-Surce-Software/Knocking
 wget https://raw.githubusercontent.com/Change-Goose-Open-Surce-Software/Knocking-Goose/main/knocking-goose-icon.png -O knocking-goose-icon.png
 wget https://raw.githubusercontent.com/Change-Goose-Open-Surce-Software/Knocking-Goose/main/kg_start.sh -O kg_start.sh
 wget https://raw.githubusercontent.com/Change-Goose-Open-Surce-Software/Knocking-Goose/main/kg_start.desktop -O kg_start.desktop
+wget https://raw.githubusercontent.com/Change-Goose-Open-Surce-Software/Knocking-Goose/main/knocking-goose.service -O knocking-goose.service
 
-# Install dependencies using apt only
-echo "Installing dependencies..."
-sudo apt-get update
-sudo apt-get install -y \
-    python3 \
-    python3-tk \
-    python3-gi \
-    python3-pyudev \
-    gir1.2-gstreamer-1.0 \
-    gstreamer1.0-plugins-base \
-    gstreamer1.0-plugins-good \
-    gstreamer1.0-plugins-bad \
-    gstreamer1.0-plugins-ugly \
-    gstreamer1.0-tools
+# Install dependencies using apt only, and only if some are missing
+PACKAGES="python3 python3-tk python3-gi python3-pyudev gir1.2-gstreamer-1.0 gstreamer1.0-plugins-base \
+    gstreamer1.0-plugins-good gstreamer1.0-plugins-bad gstreamer1.0-plugins-ugly gstreamer1.0-tools"
+MISSING=""
+for package in $PACKAGES; do
+    dpkg-query -W -f='${Status}' "$package" 2>/dev/null | grep -q "ok installed" || MISSING="$MISSING $package"
+done
+if [ -n "$MISSING" ]; then
+    echo "Installing dependencies:$MISSING"
+    sudo apt-get update
+    sudo apt-get install -y $MISSING
+else
+    echo "Dependencies already installed"
+fi
 
 # Copy files to the appropriate locations
 echo "Copying files..."
@@ -39,6 +40,7 @@ sudo cp knocking-goose.py /usr/bin/kg
 sudo cp knocking-goose-icon.png /usr/share/icons/knocking-goose-icon.png
 sudo cp kg_start.sh /usr/bin/kg_start.sh
 sudo cp kg_start.desktop /etc/xdg/autostart/kg_start.desktop
+sudo cp knocking-goose.service /etc/systemd/system/knocking-goose.service
 
 # Make scripts executable
 sudo chmod +x /usr/bin/kg
@@ -73,7 +75,7 @@ fi
 
 # Cleanup downloaded files
 echo "Cleaning up..."
-rm -f knocking-goose.py knocking-goose-icon.png kg_start.sh kg_start.desktop
+rm -f knocking-goose.py knocking-goose-icon.png kg_start.sh kg_start.desktop knocking-goose.service
 
 echo ""
 echo "=========================================="
@@ -85,6 +87,7 @@ echo ""
 echo "✓ System-wide autostart configured at: /etc/xdg/autostart/kg_start.desktop"
 echo "✓ Startup script at: /usr/bin/kg_start.sh"
 echo "✓ Auto-updater at: /usr/bin/kg_install-knocking-goose-linux.sh"
+echo "✓ Optional system-wide monitor: sudo systemctl enable --now knocking-goose"
 echo ""
 echo "Knocking Goose will automatically start for ALL users on login!"
 echo ""
@@ -1,9 +1,13 @@
 #!/bin/bash
 
-sudo wget https://raw.githubusercontent.com/Change-Goose-Open-Surce-Software/Knock/main/install-knocking-goose-linux.sh -O /usr/bin/kg_install-knocking-goose-linux.sh
-
-sudo chmod +x /usr/bin/kg_install-knocking-goose-linux.sh
-
-sudo /usr/bin/kg_install-knocking-goose-linux.sh
-
-kg
+# Only files whose checksum changed are downloaded and apt only runs for missing packages,
+# so this is usually a single conditional request; it runs in the background to keep login fast
+(sudo -n /usr/bin/kg update --quiet > /dev/null 2>&1 &)
+
+# With the system-wide monitor running, this session only needs a thin client; a socket left
+# behind by a monitor that was killed refuses connections, so run a local monitor then
+if python3 -c "import socket; socket.socket(socket.AF_UNIX).connect('/run/knocking-goose.sock')" 2>/dev/null; then
+    kg --client
+else
+    kg
+fi
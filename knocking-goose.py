@@ -5,23 +5,79 @@ import os
 import sys
 import argparse
 import threading
+import importlib.util
+import queue
 import time
 import subprocess
+import socket
+import fcntl
+from contextlib import contextmanager
 import fnmatch
+import re
+import random
+import signal
+import bisect
+from collections import OrderedDict, deque
+import sqlite3
 from datetime import datetime, timedelta
-import gi
-gi.require_version('Gst', '1.0')
-from gi.repository import Gst
-import pyudev
 
-# Initialize GStreamer
-Gst.init(None)
+def lazy_import(name):
+    """Import a module on first attribute access, so commands that never use it don't pay for it"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return importlib.import_module(name)  # Raises the usual ImportError
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent:
+        # Bind it on the package like a normal import, 'from . import' style users rely on it
+        setattr(sys.modules[parent], child, module)
+    loader.exec_module(module)
+    return module
+
+# Only the monitor needs these; config commands like 'kg colour' never load them
+asyncio = lazy_import('asyncio')
+concurrent_futures = lazy_import('concurrent.futures')
+pyudev = lazy_import('pyudev')
+urllib_request = lazy_import('urllib.request')  # Only 'kg update' downloads anything
+hashlib = lazy_import('hashlib')
+tempfile = lazy_import('tempfile')
+tracemalloc = lazy_import('tracemalloc')
+cProfile = lazy_import('cProfile')  # Only 'kg --profile' loads the profilers
+pstats = lazy_import('pstats')
+Gst = None  # Set by init_gstreamer()
 
 # Global variables
-recent_events = []
-event_lock = threading.Lock()
+deduplicator = None  # Duplicate suppression used by the monitor
 debug_mode = False
-device_snapshot = {}  # Stores current connected devices
+device_index = None  # Connected devices, maintained by the monitor
+config_cache = None  # In-memory config used by the running monitor
+event_log = None  # Connection history store, opened on first use
+user_log = None  # This user's own store while event_log is the system monitor's
+event_log_lock = threading.RLock()  # Opening the log loads the config, which may log migrated events
+sound_player = None  # Background playback used by the monitor
+resolvers = {}  # Rule kind -> (config objects it was built from, RuleResolver)
+
+CONFIG_FILE = os.path.expanduser('~/.config/kg_config.json')
+USER_HISTORY_DB = os.path.expanduser('~/.config/kg_history.db')
+HISTORY_DB = USER_HISTORY_DB  # The system monitor's database for 'kg --system' and 'kg --client'
+# Without XDG_RUNTIME_DIR (root under systemd, some ssh sessions) the socket goes into a private
+# directory; straight in /tmp any local user could create it first and receive config changes
+CONTROL_DIR = os.environ.get('XDG_RUNTIME_DIR') or f"/tmp/kg-{os.getuid()}"
+CONTROL_SOCKET = os.path.join(CONTROL_DIR, f"kg-{os.getuid()}.sock")
+# Shared by 'kg --system' and the 'kg --client' of every session
+SYSTEM_SOCKET = '/run/knocking-goose.sock'
+SYSTEM_HISTORY_DB = '/var/lib/knocking-goose/history.db'
+
+VERSION = '4.0'
+
+# Updates: manifest.json under UPDATE_URL lists every installed file with its hash
+UPDATE_URL = os.environ.get('KG_UPDATE_URL', 'https://raw.githubusercontent.com/Change-Goose-Open-Surce-Software/Knocking-Goose/main')
+UPDATE_CACHE = '/var/cache/knocking-goose' if os.geteuid() == 0 else os.path.expanduser('~/.cache/knocking-goose')
 
 # Sound paths
 SOUNDS_DIR = "/usr/share/knocking-goose/sounds"
@@ -76,7 +132,7 @@ def colorize(text, color_code):
     return f"{color_code}{text}{Colors.RESET}"
 
 def load_config():
-    config_file = os.path.expanduser('~/.config/kg_config.json')
+    config_file = CONFIG_FILE
     default_config = {
         'sound_mappings': {},  # New format: device/vendor -> {connect: path, disconnect: path}
         'device_actions': {},
@@ -84,7 +140,28 @@ def load_config():
         'vendor_colors': {},
         'volume': 100,
         'blacklist': [],
-        'history': []
+        'history_max_events': 0,  # 0 = keep everything
+        'history_max_days': 365,  # 0 = keep everything
+        'sound_overlap': 'queue',  # queue, drop or mix overlapping clips
+        'sound_pool_size': 3,  # Pipelines used when mixing
+        'sound_timeout': 10,  # Seconds before a clip is abandoned
+        'sound_cache_mb': 32,  # Memory bound for decoded sounds
+        'dedup_window': 0.5,  # Seconds in which a repeated event is ignored
+        'dedup_windows': {},  # Per device/vendor pattern overrides of dedup_window
+        'coalesce_window': 0.3,  # Seconds to gather the udev events of one plug (with --interfaces)
+        'udev_tags': [],  # Only receive devices carrying at least one of these udev tags
+        'event_queue_size': 256,  # Events buffered between daemon stages
+        'event_queue_policy': 'drop-oldest',  # drop-oldest or drop-newest when a stage falls behind
+        'action_concurrency': 4,  # Action scripts running at the same time
+        'action_timeout': 30,  # Seconds before an action script is killed
+        'action_debounce': 2.0,  # Seconds in which a device does not trigger its action again
+        'metrics': False,  # Time every monitor stage for 'kg metrics'
+        'metrics_port': 0,  # Serve Prometheus metrics on 127.0.0.1:PORT, 0 = off
+        'storm_rate': 5.0,  # Events per second of all devices before a storm is declared, 0 = off
+        'storm_burst': 4,  # Events allowed at once before storm_rate applies
+        'storm_device_rate': 1.0,  # The same per device, for a single flapping device
+        'storm_device_burst': 6,
+        'storm_sound': None  # Played once when a storm ends; default: the sound of its first event
     }
     
     config_dir = os.path.dirname(config_file)
@@ -96,9 +173,17 @@ def load_config():
             with open(config_file, 'r') as f:
                 config = json.load(f)
         except (json.JSONDecodeError, ValueError):
-            print("Warning: Config file is corrupted, creating new one...")
+            print(f"Warning: Config file is corrupted, creating new one (old file kept as {config_file}.corrupt)...")
+            os.replace(config_file, config_file + '.corrupt')
             config = {}
         
+        migrating = 'disconnect_sound' in config or 'device_connect_sounds' in config or 'history' in config
+        if migrating and not getattr(config_lock_state, 'depth', 0):
+            # A migration rewrites the file; the monitor and a CLI command starting together at login
+            # must not both import the history, so read it again under the lock
+            with config_lock():
+                return load_config()
+        
         # Migration from v4.0
         if 'disconnect_sound' in config or 'device_connect_sounds' in config:
             print("Migrating config from v4.0 to v4.0...")
@@ -126,234 +211,2603 @@ def load_config():
                 if key in config:
                     new_config[key] = config[key]
             
-            with open(config_file, 'w') as f:
-                json.dump(new_config, f, indent=4)
+            migrate_history(new_config)
+            save_config(new_config)
             return new_config
         
         for key in default_config:
             if key not in config:
                 config[key] = default_config[key]
+        if migrate_history(config):
+            save_config(config)
         return config
     else:
-        with open(config_file, 'w') as f:
-            json.dump(default_config, f, indent=4)
+        save_config(default_config)
         return default_config
 
+def migrate_history(config):
+    """Move a legacy 'history' array from the config into the user's event log"""
+    if 'history' not in config:
+        return False
+    history = config.pop('history') or []
+    if history:
+        print(f"Migrating {len(history)} history events to {USER_HISTORY_DB}...")
+        get_user_log().append_many(history)
+    return True
+
 def save_config(config):
-    config_file = os.path.expanduser('~/.config/kg_config.json')
-    with open(config_file, 'w') as f:
+    """Write the config atomically so readers never see a half-written file"""
+    tmp_file = f"{CONFIG_FILE}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
         json.dump(config, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, CONFIG_FILE)
+
+config_lock_state = threading.local()  # How deeply the current thread holds config_lock
+
+@contextmanager
+def config_lock():
+    """Serialize read-modify-write cycles on the config between processes; a thread may nest it"""
+    depth = getattr(config_lock_state, 'depth', 0)
+    if depth:
+        # A second flock() on a new descriptor would wait for the one this thread holds
+        config_lock_state.depth = depth + 1
+        try:
+            yield
+        finally:
+            config_lock_state.depth = depth
+        return
+    with open(CONFIG_FILE + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        config_lock_state.depth = 1
+        try:
+            yield
+        finally:
+            config_lock_state.depth = 0
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class ConfigCache:
+    """Keeps the parsed config in memory and reloads it only when the file changes"""
+    def __init__(self, config=None):
+        self.config = config
+        self.fixed = config is not None  # A given config (benchmarks) is never reloaded
+        self.stamp = None
+        self.lock = threading.Lock()
+    
+    def _stat(self):
+        try:
+            st = os.stat(CONFIG_FILE)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    
+    def get(self):
+        if self.fixed:
+            return self.config
+        # A stat() per event is far cheaper than re-parsing the whole file
+        stamp = self._stat()
+        with self.lock:
+            if self.config is None or stamp != self.stamp:
+                self.config = load_config()
+                # The stamp from before parsing: a write that lands while load_config runs is seen next time
+                self.stamp = stamp
+                if debug_mode:
+                    print("DEBUG: Config (re)loaded from disk")
+            return self.config
+    
+    def invalidate(self):
+        with self.lock:
+            self.stamp = None
+    
+    def save(self, config):
+        with self.lock:
+            save_config(config)
+            self.config = config
+            self.stamp = self._stat()
+
+def get_config():
+    """Return the cached config inside the monitor, a fresh one otherwise"""
+    if config_cache is not None:
+        return config_cache.get()
+    return load_config()
 
 def get_device_color(device_id, vendor_id, config):
-    if device_id in config.get('device_colors', {}):
-        return Colors.get_color(config['device_colors'][device_id])
-    elif vendor_id and vendor_id in config.get('vendor_colors', {}):
-        return Colors.get_color(config['vendor_colors'][vendor_id])
-    return Colors.WHITE
+    color = get_resolver(config, 'color').match(device_id, vendor_id)
+    return Colors.get_color(color) if color else Colors.WHITE
+
+def init_gstreamer():
+    """Load and initialize GStreamer on first use; its plugin registry scan is the slowest part of startup"""
+    global Gst
+    if Gst is None:
+        import gi
+        gi.require_version('Gst', '1.0')
+        from gi.repository import Gst as gst
+        gst.init(None)
+        Gst = gst
+    return Gst
 
-def play_sound(sound_file, volume=100):
+def play_on(player, sound_file, volume=100, timeout=10):
+    """Play one clip on an existing playbin, giving up after timeout seconds; returns False if it failed"""
+    player.set_property("uri", "file://" + os.path.abspath(sound_file))
+    player.set_property("volume", volume / 100.0)
+    player.set_state(Gst.State.PLAYING)
+    bus = player.get_bus()
+    msg = bus.timed_pop_filtered(int(timeout * Gst.SECOND), Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    player.set_state(Gst.State.NULL)
+    if msg is None:
+        print(f"Error playing sound: timed out after {timeout}s: {sound_file}")
+        return False
+    if msg.type == Gst.MessageType.ERROR:
+        err, _ = msg.parse_error()
+        print(f"Error playing sound: {err.message}")
+        return False
+    return True
+
+def play_sound(sound_file, volume=100, timeout=10):
     if sound_file and os.path.exists(sound_file):
         try:
+            init_gstreamer()
             player = Gst.ElementFactory.make("playbin", "player")
-            player.set_property("uri", "file://" + os.path.abspath(sound_file))
-            player.set_property("volume", volume / 100.0)
-            player.set_state(Gst.State.PLAYING)
-            bus = player.get_bus()
-            bus.poll(Gst.MessageType.EOS, Gst.CLOCK_TIME_NONE)
-            player.set_state(Gst.State.NULL)
+            play_on(player, sound_file, volume, timeout)
         except Exception as e:
             print(f"Error playing sound: {e}")
 
-def run_action(script_path, device_id):
-    if script_path and os.path.exists(script_path):
+# Every cached sound is decoded to this format so one pipeline can play any of them
+PCM_CAPS = "audio/x-raw,format=S16LE,layout=interleaved,rate=44100,channels=2"
+
+def decode_sound(sound_file, timeout=10):
+    """Decode a sound file to raw PCM bytes, or None if it cannot be decoded"""
+    init_gstreamer()
+    pipeline = Gst.parse_launch(
+        f"filesrc name=src ! decodebin ! audioconvert ! audioresample ! {PCM_CAPS} ! appsink name=sink sync=false")
+    pipeline.get_by_name("src").set_property("location", sound_file)
+    sink = pipeline.get_by_name("sink")
+    chunks = []
+    pipeline.set_state(Gst.State.PLAYING)
+    try:
+        while True:
+            sample = sink.emit("try-pull-sample", int(timeout * Gst.SECOND))
+            if sample is None:
+                break
+            buf = sample.get_buffer()
+            chunks.append(buf.extract_dup(0, buf.get_size()))
+        # try-pull-sample also returns None on errors and timeouts
+        if not sink.get_property("eos"):
+            return None
+    finally:
+        pipeline.set_state(Gst.State.NULL)
+    return b"".join(chunks)
+
+def make_pcm_pipeline():
+    init_gstreamer()
+    return Gst.parse_launch(
+        f"appsrc name=src format=time caps={PCM_CAPS} ! audioconvert ! volume name=vol ! autoaudiosink")
+
+def play_pcm(pipeline, pcm, volume=100, timeout=10):
+    """Play decoded PCM on a pipeline from make_pcm_pipeline; returns seconds until the first sample, None if it failed"""
+    start = time.perf_counter()
+    pipeline.get_by_name("vol").set_property("volume", volume / 100.0)
+    src = pipeline.get_by_name("src")
+    pipeline.set_state(Gst.State.PLAYING)
+    src.emit("push-buffer", Gst.Buffer.new_wrapped(pcm))
+    src.emit("end-of-stream")
+    # The state change completes once the sink has prerolled the first buffer
+    pipeline.get_state(int(timeout * Gst.SECOND))
+    first_sample = time.perf_counter() - start
+    bus = pipeline.get_bus()
+    msg = bus.timed_pop_filtered(int(timeout * Gst.SECOND), Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    if msg is None:
+        print(f"Error playing sound: timed out after {timeout}s")
+        return None
+    if msg.type == Gst.MessageType.ERROR:
+        err, _ = msg.parse_error()
+        print(f"Error playing sound: {err.message}")
+        return None
+    return first_sample
+
+class SoundCache:
+    """LRU cache of decoded sounds, invalidated when a file's mtime changes"""
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # path -> (mtime_ns, pcm)
+        self.size = 0
+        self.lock = threading.Lock()
+    
+    def get(self, sound_file):
+        """Return (pcm, hit); pcm is None if the file cannot be decoded"""
+        try:
+            mtime = os.stat(sound_file).st_mtime_ns
+        except OSError:
+            return None, False
+        with self.lock:
+            entry = self.entries.get(sound_file)
+            if entry and entry[0] == mtime:
+                self.entries.move_to_end(sound_file)
+                return entry[1], True
+        pcm = decode_sound(sound_file)
+        if pcm is not None:
+            self._store(sound_file, mtime, pcm)
+        return pcm, False
+    
+    def preload(self, sound_files):
+        for sound_file in sound_files:
+            try:
+                self.get(sound_file)
+            except Exception as e:
+                print(f"Error decoding sound {sound_file}: {e}")
+    
+    def _store(self, sound_file, mtime, pcm):
+        with self.lock:
+            old = self.entries.pop(sound_file, None)
+            if old:
+                self.size -= len(old[1])
+            if len(pcm) > self.max_bytes:
+                return
+            self.entries[sound_file] = (mtime, pcm)
+            self.size += len(pcm)
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+def configured_sounds(config):
+    """All sound files referenced by the config"""
+    sounds = set()
+    for mapping in config.get('sound_mappings', {}).values():
+        sounds.update(path for path in mapping.values() if path)
+    return sorted(sounds)
+
+class SoundPlayer:
+    """Plays sounds on worker threads so event handling never waits for a clip"""
+    POLICIES = ('queue', 'drop', 'mix')
+    
+    def __init__(self, policy='queue', pool_size=3, timeout=10, cache=None):
+        init_gstreamer()
+        self.policy = policy if policy in self.POLICIES else 'queue'
+        self.timeout = timeout
+        self.cache = cache
+        self.metrics = None  # Set by the monitor when metrics are enabled
+        self.requests = queue.Queue(maxsize=32)
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.workers = []
+        # Only 'mix' plays clips concurrently; the others share one pipeline
+        worker_count = max(1, pool_size) if self.policy == 'mix' else 1
+        for i in range(worker_count):
+            worker = threading.Thread(target=self._worker, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+    
+    def play(self, sound_file, volume=100):
+        """Hand a clip to the workers; returns False if it was dropped"""
+        if not sound_file or not os.path.exists(sound_file):
+            return False
+        if self.policy == 'drop':
+            with self.lock:
+                if self.busy or not self.requests.empty():
+                    return self._dropped()
         try:
+            self.requests.put_nowait((sound_file, volume, time.perf_counter()))
+        except queue.Full:
+            return self._dropped()
+        return True
+    
+    def _dropped(self):
+        if self.metrics:
+            self.metrics.count('sounds_dropped')
+        return False
+    
+    def stop(self):
+        for _ in self.workers:
+            self.requests.put(None)
+    
+    def clear(self):
+        """Drop the clips that have not started yet, e.g. those of events a storm summary replaces"""
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is None:
+                self.requests.put(None)  # Shutting down
+                return
+            self._dropped()
+    
+    def _worker(self):
+        pcm_pipeline = None  # Built with the first cached clip; False once building it failed
+        player = None
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            with self.lock:
+                self.busy += 1
+            played = False
+            try:
+                sound_file, volume, requested = request
+                pcm = self.cache.get(sound_file)[0] if self.cache else None
+                if pcm is not None and pcm_pipeline is None:
+                    try:
+                        pcm_pipeline = make_pcm_pipeline()
+                    except Exception as e:
+                        print(f"Error creating the sound pipeline, playing files directly: {e}")
+                        pcm_pipeline = False
+                if pcm is not None and pcm_pipeline:
+                    waited = time.perf_counter() - requested
+                    first_sample = play_pcm(pcm_pipeline, pcm, volume, self.timeout)
+                    played = first_sample is not None
+                    if played and self.metrics:
+                        self.metrics.observe('sound_start', waited + first_sample)
+                else:
+                    # Fall back to playbin for anything the cache could not decode or play
+                    if player is None:
+                        player = Gst.ElementFactory.make("playbin", None)
+                    played = play_on(player, sound_file, volume, self.timeout)
+            except Exception as e:
+                print(f"Error playing sound: {e}")
+            finally:
+                if self.metrics:
+                    self.metrics.count('sounds_played' if played else 'playback_failures')
+                with self.lock:
+                    self.busy -= 1
+
+class ActionRunner:
+    """Runs device action scripts with a concurrency limit, a timeout and a per-device debounce.
+    asyncio waits on every child, so finished scripts never linger as zombies"""
+    OUTPUT_LIMIT = 4096  # Bytes of script output kept in the history
+    
+    def __init__(self, concurrency=4, on_result=None):
+        self.concurrency = max(1, concurrency)
+        self.slots = None  # Made on the running loop, see MonitorDaemon.open_pipeline
+        self.on_result = on_result
+        self.last_run = {}  # device -> monotonic time of the last started action
+        self.tasks = set()
+        self.debounced = 0
+        self.metrics = None  # Set by the monitor when metrics are enabled
+    
+    def submit(self, record, timeout=30, debounce=2.0):
+        """Start the record's script in the background unless its device ran one within debounce seconds"""
+        now = time.monotonic()
+        last = self.last_run.get(record['device'])
+        if last is not None and now - last < debounce:
+            self.debounced += 1
+            if self.metrics:
+                self.metrics.count('actions_debounced')
             if debug_mode:
-                print(f"Running action: {script_path} for device: {device_id}")
-            subprocess.Popen([script_path, device_id])
-        except Exception as e:
-            print(f"Error running action: {e}")
+                print(f"DEBUG: Action for {record['device']} debounced")
+            return False
+        self.last_run[record['device']] = now
+        task = asyncio.ensure_future(self.run(record, timeout, time.perf_counter()))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+    
+    async def run(self, record, timeout, submitted=None):
+        script = record['script']
+        result = {'timestamp': datetime.now().isoformat(), 'device': record['device'], 'script': script,
+                  'exit_code': None, 'timed_out': False, 'duration': 0.0, 'output': ''}
+        env = dict(os.environ,
+                   KG_DEVICE=record['device'],
+                   KG_VENDOR=record.get('vendor') or '',
+                   KG_MODEL=record.get('model') or '',
+                   KG_ACTION=record['action'],
+                   KG_DEVPATH=record.get('devpath') or '')
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.concurrency)
+        async with self.slots:
+            start = time.monotonic()
+            if debug_mode:
+                print(f"Running action: {script} for device: {record['device']}")
+            try:
+                # A session of its own lets a timeout kill everything the script started
+                process = await asyncio.create_subprocess_exec(
+                    script, record['device'], env=env, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+            except OSError as e:
+                result['output'] = str(e)
+            else:
+                if self.metrics and submitted is not None:
+                    self.metrics.observe('action_spawn', time.perf_counter() - submitted)
+                try:
+                    output, _ = await asyncio.wait_for(process.communicate(), timeout)
+                    result['output'] = output[-self.OUTPUT_LIMIT:].decode(errors='replace')
+                except asyncio.TimeoutError:
+                    result['timed_out'] = True
+                    await self.kill(process)
+                except asyncio.CancelledError:
+                    await self.kill(process)
+                    raise
+                result['exit_code'] = process.returncode
+            result['duration'] = time.monotonic() - start
+        if self.metrics:
+            self.metrics.count('actions_run' if result['exit_code'] == 0 else 'action_failures')
+        if result['timed_out'] or result['exit_code'] != 0:
+            reason = f"timed out after {timeout}s" if result['timed_out'] else \
+                f"exited with {result['exit_code']}" if result['exit_code'] is not None else result['output']
+            print(colorize(f"Action {script} for {record['device']} {reason}", Colors.YELLOW))
+        if self.on_result:
+            self.on_result(result)
+        return result
+    
+    async def kill(self, process):
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, sig)
+            except ProcessLookupError:
+                break
+            try:
+                await asyncio.wait_for(process.wait(), 2)
+                break
+            except asyncio.TimeoutError:
+                continue
+    
+    def running(self):
+        return len(self.tasks)
 
 def get_vendor_id(device):
     vendor = device.get('ID_VENDOR_ID', '')
     return vendor if vendor else None
 
-def is_duplicate_event(action, device_id, window=0.5):
-    global recent_events
-    current_time = time.time()
-    event_key = f"{action}:{device_id}"
-    with event_lock:
-        recent_events = [(t, k) for t, k in recent_events if current_time - t < window]
-        for _, key in recent_events:
-            if key == event_key:
+class EventDeduplicator:
+    """Suppresses repeats of the same action/device within a time window"""
+    def __init__(self):
+        self.last_seen = {}  # (action, device_id) -> (monotonic time, window)
+        self.order = deque()  # (monotonic time, key), oldest first
+        self.max_window = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+    
+    def is_duplicate(self, action, device_id, window=0.5):
+        now = time.monotonic()
+        key = (action, device_id)
+        with self.lock:
+            self.max_window = max(self.max_window, window)
+            # Every entry is appended and popped once, so expiry is O(1) amortized
+            while self.order and now - self.order[0][0] >= self.max_window:
+                seen, old_key = self.order.popleft()
+                if self.last_seen.get(old_key, (None,))[0] == seen:
+                    del self.last_seen[old_key]
+            entry = self.last_seen.get(key)
+            if entry and now - entry[0] < entry[1]:
+                self.suppressed += 1
                 return True
-        recent_events.append((current_time, event_key))
+            self.last_seen[key] = (now, window)
+            self.order.append((now, key))
+            return False
+
+class TokenBucket:
+    """Allows rate events per second on average and bursts of up to burst events"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = None
+    
+    def _refill(self, now):
+        if self.last is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+    
+    def take(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
         return False
+    
+    def time_to_full(self, now):
+        self._refill(now)
+        return (self.burst - self.tokens) / self.rate
 
-def log_event(device_id, action, vendor_id=None):
-    config = load_config()
-    event = {'timestamp': datetime.now().isoformat(), 'device': device_id, 'action': action, 'vendor': vendor_id}
-    if 'history' not in config:
-        config['history'] = []
-    config['history'].append(event)
-    if len(config['history']) > 1000:
-        config['history'] = config['history'][-1000:]
-    save_config(config)
-
-def take_device_snapshot():
-    """Take snapshot of currently connected devices"""
-    global device_snapshot
-    context = pyudev.Context()
-    snapshot = {}
-    for device in context.list_devices(subsystem='usb'):
-        device_id = device.get('ID_SERIAL', 'default')
-        vendor_id = device.get('ID_VENDOR_ID', 'N/A')
-        if device_id != 'default':
-            snapshot[device_id] = vendor_id
-    device_snapshot = snapshot
-    return snapshot
+class StormDetector:
+    """Token buckets for all devices together and for each device. Once one runs dry a storm begins:
+    the events of an exhausted device, or all events if the global bucket ran dry, are batched into it.
+    The storm ends when the buckets that ran dry have refilled"""
+    MAX_DEVICES = 1024  # Idle device buckets are forgotten beyond this many
+    
+    def __init__(self, rate=5.0, burst=4, device_rate=1.0, device_burst=6):
+        self.enabled = rate > 0 and device_rate > 0
+        self.bucket = TokenBucket(rate, burst)
+        self.device_rate = device_rate
+        self.device_burst = device_burst
+        self.devices = {}  # device -> TokenBucket
+        self.storm = None
+        # Events announced before a storm began belong to the burst that set it off, so the summary counts
+        # them too; a full bucket refills in burst / rate seconds, the burst is what came within that time
+        self.global_window = burst / rate if self.enabled else 0
+        self.window = max(self.global_window, device_burst / device_rate) if self.enabled else 0
+        self.recent = deque()  # (received, wall_time, device, vendor, action, sound)
+    
+    def admit(self, record):
+        """Whether the record is announced on its own; if not, it was added to the storm"""
+        if not self.enabled:
+            return True
+        now = record['received']
+        device = record['device']
+        bucket = self.devices.get(device)
+        if bucket is None:
+            if len(self.devices) >= self.MAX_DEVICES:
+                self.devices = {key: b for key, b in self.devices.items() if b.time_to_full(now) > 0}
+            bucket = self.devices[device] = TokenBucket(self.device_rate, self.device_burst)
+        device_ok = bucket.take(now)
+        global_ok = self.bucket.take(now)
+        storm = self.storm
+        if storm is None:
+            while self.recent and self.recent[0][0] < now - self.window:
+                self.recent.popleft()
+            if device_ok and global_ok:
+                self.recent.append((now, record['wall_time'], device, record['vendor'], record['action'], record['sound']))
+                return True
+            storm = self.storm = {'monotonic': now, 'time': record['wall_time'], 'scope': 'device' if global_ok else 'global',
+                                  'events': 0, 'devices': {}, 'sound': None, 'color': record['color']}
+            # The events that drained the bucket were announced one by one; they are part of the storm all the same
+            for received, wall_time, other, vendor, action, sound in self.recent:
+                if other == device if storm['scope'] == 'device' else received >= now - self.global_window:
+                    if not storm['events']:
+                        storm['monotonic'], storm['time'] = received, wall_time
+                    self._count(storm, other, vendor, action, sound)
+            self.recent.clear()
+        if not global_ok:
+            storm['scope'] = 'global'
+        # In a device storm only the flapping devices are batched
+        if storm['scope'] == 'device' and device_ok and device not in storm['devices']:
+            return True
+        self._count(storm, device, record['vendor'], record['action'], record['sound'])
+        return False
+    
+    def _count(self, storm, device, vendor, action, sound):
+        counts = storm['devices'].setdefault(device, {'vendor': vendor, 'add': 0, 'remove': 0})
+        counts['add' if action == 'add' else 'remove'] += 1
+        storm['events'] += 1
+        storm['sound'] = storm['sound'] or sound
+    
+    def time_to_recover(self, now):
+        """Seconds until the buckets that started the storm are full again; 0 once it is over"""
+        if self.storm['scope'] == 'global':
+            # A device still flapping afterwards starts a device storm of its own
+            return self.bucket.time_to_full(now)
+        return max((self.devices[device].time_to_full(now) for device in self.storm['devices'] if device in self.devices),
+                   default=0)
+    
+    def end(self, now):
+        storm, self.storm = self.storm, None
+        return dict(storm, duration=now - storm['monotonic'], summary=storm_summary(storm))
+
+def storm_summary(storm):
+    """'14 devices reconnected, 2 disconnected' for the devices of a storm"""
+    kinds = {'reconnected': 0, 'connected': 0, 'disconnected': 0}
+    for counts in storm['devices'].values():
+        kinds['reconnected' if counts['add'] and counts['remove'] else 'connected' if counts['add'] else 'disconnected'] += 1
+    if len(storm['devices']) == 1:
+        device, counts = next(iter(storm['devices'].items()))
+        return f"{device} {next(kind for kind, n in kinds.items() if n)} {max(counts['add'], counts['remove'])} times"
+    parts = [f"{n} device{'s' if n != 1 else ''} {kind}" for kind, n in kinds.items() if n]
+    return ", ".join(parts)
+
+class EventLog:
+    """Append-only connection history stored in SQLite, with aggregates kept up to date on every append"""
+    PRUNE_EVERY = 100  # Retention is enforced every N appends, not on each one
+    SCHEMA_VERSION = 3
+    
+    def __init__(self, path=HISTORY_DB):
+        self.path = path
+        self.lock = threading.Lock()
+        self.appends = 0
+        # Session users can read the system monitor's history but not write it
+        self.readonly = os.path.exists(path) and not os.access(path, os.W_OK)
+        self.conn, self.immutable = self._connect()
+        if self.readonly:
+            return
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            device TEXT NOT NULL,
+            action TEXT NOT NULL,
+            vendor TEXT)''')
+        self._migrate()
+    
+    def _connect(self):
+        """Returns (connection, immutable)"""
+        if not self.readonly:
+            return sqlite3.connect(self.path, timeout=10, check_same_thread=False), False
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=10, check_same_thread=False)
+        try:
+            conn.execute('SELECT 1 FROM events LIMIT 1')
+        except sqlite3.OperationalError:
+            # Without a running writer SQLite cannot set up WAL shared memory for a reader;
+            # nothing changes the file right now, so it can be read as immutable
+            conn.close()
+            return sqlite3.connect(f"file:{self.path}?immutable=1", uri=True, check_same_thread=False), True
+        return conn, False
+    
+    def _reader(self):
+        """The connection for one query; call with the lock held"""
+        if self.immutable:
+            # An immutable handle goes stale (or reads torn pages) once the system monitor
+            # starts writing, so reopen it per query and use mode=ro as soon as that works
+            self.conn.close()
+            self.conn, self.immutable = self._connect()
+        return self.conn
+    
+    def _migrate(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < 2:
+            # Time index for history queries, plus aggregates that survive pruning
+            with self.conn:
+                self.conn.execute('CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp)')
+                self.conn.execute('''CREATE TABLE IF NOT EXISTS device_stats (
+                    device TEXT PRIMARY KEY,
+                    vendor TEXT,
+                    connects INTEGER NOT NULL DEFAULT 0,
+                    disconnects INTEGER NOT NULL DEFAULT 0,
+                    first_seen TEXT,
+                    last_seen TEXT)''')
+                self.conn.execute('''CREATE TABLE IF NOT EXISTS vendor_stats (
+                    vendor TEXT PRIMARY KEY,
+                    connects INTEGER NOT NULL DEFAULT 0,
+                    disconnects INTEGER NOT NULL DEFAULT 0,
+                    first_seen TEXT,
+                    last_seen TEXT)''')
+                self.conn.execute('''CREATE TABLE IF NOT EXISTS rollups (
+                    period TEXT NOT NULL,
+                    bucket TEXT NOT NULL,
+                    device TEXT NOT NULL,
+                    vendor TEXT,
+                    connects INTEGER NOT NULL DEFAULT 0,
+                    disconnects INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (period, bucket, device))''')
+                rows = self.conn.execute('SELECT timestamp, device, action, vendor FROM events ORDER BY id').fetchall()
+                for timestamp, device, action, vendor in rows:
+                    self._aggregate({'timestamp': timestamp, 'device': device, 'action': action, 'vendor': vendor})
+                self.conn.execute('PRAGMA user_version = 2')
+        if version < 3:
+            # Outcome of every action script the monitor ran
+            with self.conn:
+                self.conn.execute('''CREATE TABLE IF NOT EXISTS actions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp TEXT NOT NULL,
+                    device TEXT NOT NULL,
+                    script TEXT NOT NULL,
+                    exit_code INTEGER,
+                    timed_out INTEGER NOT NULL DEFAULT 0,
+                    duration REAL,
+                    output TEXT)''')
+                self.conn.execute('CREATE INDEX IF NOT EXISTS actions_timestamp ON actions (timestamp)')
+                self.conn.execute('PRAGMA user_version = 3')
+        if version < 4:
+            # Event times per bucket, so windowed stats report when a device was seen, not just the hour
+            with self.conn:
+                self.conn.execute('ALTER TABLE rollups ADD COLUMN first_seen TEXT')
+                self.conn.execute('ALTER TABLE rollups ADD COLUMN last_seen TEXT')
+                for period, length in (('hour', 13), ('day', 10)):
+                    rows = self.conn.execute('''SELECT MIN(timestamp), MAX(timestamp), substr(timestamp, 1, ?), device FROM events
+                        GROUP BY substr(timestamp, 1, ?), device''', (length, length)).fetchall()
+                    self.conn.executemany('''UPDATE rollups SET first_seen = ?, last_seen = ?
+                        WHERE period = ? AND bucket = ? AND device = ?''',
+                        [(first, last, period, bucket, device) for first, last, bucket, device in rows])
+                self.conn.execute('PRAGMA user_version = 4')
+    
+    def _aggregate(self, event):
+        timestamp = event['timestamp']
+        vendor = event.get('vendor')
+        connects = 1 if event['action'] == 'add' else 0
+        disconnects = 1 - connects
+        self.conn.execute('''INSERT INTO device_stats (device, vendor, connects, disconnects, first_seen, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (device) DO UPDATE SET
+                vendor = COALESCE(excluded.vendor, vendor),
+                connects = connects + excluded.connects,
+                disconnects = disconnects + excluded.disconnects,
+                first_seen = MIN(first_seen, excluded.first_seen),
+                last_seen = MAX(last_seen, excluded.last_seen)''',
+            (event['device'], vendor, connects, disconnects, timestamp, timestamp))
+        if vendor:
+            self.conn.execute('''INSERT INTO vendor_stats (vendor, connects, disconnects, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (vendor) DO UPDATE SET
+                    connects = connects + excluded.connects,
+                    disconnects = disconnects + excluded.disconnects,
+                    first_seen = MIN(first_seen, excluded.first_seen),
+                    last_seen = MAX(last_seen, excluded.last_seen)''',
+                (vendor, connects, disconnects, timestamp, timestamp))
+        # ISO timestamps make the hour and day buckets plain prefixes
+        for period, bucket in (('hour', timestamp[:13]), ('day', timestamp[:10])):
+            # Buckets from before version 4 whose events were pruned have no times; MIN/MAX would keep NULL
+            self.conn.execute('''INSERT INTO rollups (period, bucket, device, vendor, connects, disconnects, first_seen, last_seen)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (period, bucket, device) DO UPDATE SET
+                    vendor = COALESCE(excluded.vendor, vendor),
+                    connects = connects + excluded.connects,
+                    disconnects = disconnects + excluded.disconnects,
+                    first_seen = MIN(COALESCE(first_seen, excluded.first_seen), excluded.first_seen),
+                    last_seen = MAX(COALESCE(last_seen, excluded.last_seen), excluded.last_seen)''',
+                (period, bucket, event['device'], vendor, connects, disconnects, timestamp, timestamp))
+    
+    def _insert(self, event):
+        self.conn.execute('INSERT INTO events (timestamp, device, action, vendor) VALUES (?, ?, ?, ?)',
+                          (event['timestamp'], event['device'], event['action'], event.get('vendor')))
+        self._aggregate(event)
+    
+    def append(self, event, max_events=0, max_days=0):
+        with self.lock:
+            with self.conn:
+                self._insert(event)
+            self.appends += 1
+            if self.appends % self.PRUNE_EVERY == 0:
+                self._prune(max_events, max_days)
+    
+    def append_many(self, events, max_events=0, max_days=0):
+        """Insert a batch in one transaction, e.g. the events of a storm"""
+        with self.lock:
+            with self.conn:
+                for event in events:
+                    self._insert(event)
+            before = self.appends
+            self.appends += len(events)
+            if self.appends // self.PRUNE_EVERY > before // self.PRUNE_EVERY:
+                self._prune(max_events, max_days)
+    
+    def prune(self, max_events=0, max_days=0):
+        with self.lock:
+            self._prune(max_events, max_days)
+    
+    def _prune(self, max_events, max_days):
+        # Only raw events and hourly rollups expire; totals and daily rollups are kept
+        with self.conn:
+            if max_events:
+                self.conn.execute('DELETE FROM events WHERE id <= (SELECT MAX(id) FROM events) - ?', (max_events,))
+            if max_days:
+                cutoff = (datetime.now() - timedelta(days=max_days)).isoformat()
+                self.conn.execute('DELETE FROM events WHERE timestamp < ?', (cutoff,))
+                self.conn.execute("DELETE FROM rollups WHERE period = 'hour' AND bucket < ?", (cutoff[:13],))
+                self.conn.execute('DELETE FROM actions WHERE timestamp < ?', (cutoff,))
+    
+    def append_action(self, result):
+        with self.lock:
+            with self.conn:
+                self.conn.execute('''INSERT INTO actions (timestamp, device, script, exit_code, timed_out, duration, output)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                    (result['timestamp'], result['device'], result['script'], result['exit_code'],
+                     int(result['timed_out']), result['duration'], result['output']))
+    
+    def actions(self, since=None):
+        with self.lock:
+            rows = self._reader().execute('''SELECT timestamp, device, script, exit_code, timed_out, duration, output FROM actions
+                WHERE timestamp >= ? ORDER BY timestamp, id''', (since or '',)).fetchall()
+        return [{'timestamp': timestamp, 'device': device, 'script': script, 'exit_code': exit_code,
+                 'timed_out': bool(timed_out), 'duration': duration, 'output': output}
+                for timestamp, device, script, exit_code, timed_out, duration, output in rows]
+    
+    def events(self, since=None):
+        """Yield stored events, oldest first; since (ISO timestamp) uses the time index"""
+        with self.lock:
+            rows = self._reader().execute('SELECT timestamp, device, action, vendor FROM events WHERE timestamp >= ? ORDER BY timestamp, id',
+                                          (since or '',)).fetchall()
+        for timestamp, device, action, vendor in rows:
+            yield {'timestamp': timestamp, 'device': device, 'action': action, 'vendor': vendor}
+    
+    def stream(self, since=None):
+        """Iterate events oldest first without loading them all; uses its own read connection"""
+        conn, _ = self._connect()
+        try:
+            cursor = conn.execute('SELECT timestamp, device, action, vendor FROM events WHERE timestamp >= ? ORDER BY timestamp, id',
+                                  (since or '',))
+            for timestamp, device, action, vendor in cursor:
+                yield {'timestamp': timestamp, 'device': device, 'action': action, 'vendor': vendor}
+        finally:
+            conn.close()
+    
+    def device_stats(self, since=None, top=None):
+        """Per-device totals, busiest first; since limits them to hourly rollups from that time on"""
+        if since is None:
+            query = '''SELECT device, vendor, connects, disconnects, first_seen, last_seen FROM device_stats
+                ORDER BY connects DESC, disconnects DESC'''
+            params = ()
+        else:
+            query = '''SELECT device, MAX(vendor), SUM(connects), SUM(disconnects),
+                MIN(COALESCE(first_seen, bucket)), MAX(COALESCE(last_seen, bucket)) FROM rollups
+                WHERE period = 'hour' AND bucket >= ? GROUP BY device ORDER BY SUM(connects) DESC, SUM(disconnects) DESC'''
+            params = (since[:13],)
+        if top:
+            query += f' LIMIT {int(top)}'
+        with self.lock:
+            rows = self._reader().execute(query, params).fetchall()
+        return {device: {'vendor': vendor or 'N/A', 'connects': connects, 'disconnects': disconnects,
+                         'first_seen': first_seen, 'last_seen': last_seen}
+                for device, vendor, connects, disconnects, first_seen, last_seen in rows}
+    
+    def vendor_stats(self, since=None, top=None):
+        if since is None:
+            query = '''SELECT vendor, connects, disconnects, first_seen, last_seen FROM vendor_stats
+                ORDER BY connects DESC, disconnects DESC'''
+            params = ()
+        else:
+            query = '''SELECT vendor, SUM(connects), SUM(disconnects),
+                MIN(COALESCE(first_seen, bucket)), MAX(COALESCE(last_seen, bucket)) FROM rollups
+                WHERE period = 'hour' AND bucket >= ? AND vendor IS NOT NULL GROUP BY vendor
+                ORDER BY SUM(connects) DESC, SUM(disconnects) DESC'''
+            params = (since[:13],)
+        if top:
+            query += f' LIMIT {int(top)}'
+        with self.lock:
+            rows = self._reader().execute(query, params).fetchall()
+        return {vendor: {'connects': connects, 'disconnects': disconnects, 'first_seen': first_seen, 'last_seen': last_seen}
+                for vendor, connects, disconnects, first_seen, last_seen in rows}
+    
+    def rollups(self, period='day', since=None):
+        """Connects/disconnects per bucket of an hour or day, summed over all devices"""
+        with self.lock:
+            rows = self._reader().execute('''SELECT bucket, SUM(connects), SUM(disconnects) FROM rollups
+                WHERE period = ? AND bucket >= ? GROUP BY bucket ORDER BY bucket''', (period, since or '')).fetchall()
+        return [{'bucket': bucket, 'connects': connects, 'disconnects': disconnects} for bucket, connects, disconnects in rows]
 
-def find_disconnected_device():
-    """Find which device was disconnected by comparing snapshots"""
-    global device_snapshot
-    new_snapshot = take_device_snapshot()
+def get_event_log():
+    global event_log
+    with event_log_lock:
+        if event_log is None:
+            if not os.path.exists(HISTORY_DB) and not os.access(os.path.dirname(HISTORY_DB), os.W_OK) and os.geteuid() != 0:
+                # A client before the system monitor created its history: empty until then, so nothing is kept
+                return EventLog(':memory:')
+            os.makedirs(os.path.dirname(HISTORY_DB), exist_ok=True)
+            event_log = EventLog(HISTORY_DB)
+            # load_config imports a legacy 'history' array from the config; that has to happen
+            # before the first read, or 'kg history' shows nothing until another command loads it
+            get_config()
+    return event_log
+
+def get_user_log():
+    """The log this user can write; a client only reads the system monitor's"""
+    global user_log
+    if HISTORY_DB == USER_HISTORY_DB:
+        return get_event_log()
+    if user_log is None:
+        os.makedirs(os.path.dirname(USER_HISTORY_DB), exist_ok=True)
+        user_log = EventLog(USER_HISTORY_DB)
+    return user_log
+
+def log_event(device_id, action, vendor_id=None, timestamp=None):
+    """timestamp (ISO) is when the event was received; by the time the log thread runs it, now is later"""
+    config = get_config()
+    event = {'timestamp': timestamp or datetime.now().isoformat(), 'device': device_id, 'action': action, 'vendor': vendor_id}
+    get_event_log().append(event, config.get('history_max_events', 0), config.get('history_max_days', 0))
+
+def log_events(events):
+    config = get_config()
+    get_event_log().append_many(events, config.get('history_max_events', 0), config.get('history_max_days', 0))
+
+def record_action(result):
+    # Actions run in the user's session, so a client keeps their results next to its own history
+    get_user_log().append_action(result)
+
+def device_info(device):
+    """The properties of a usb_device that the monitor and 'kg list' need"""
+    return {'serial': device.get('ID_SERIAL', 'default'),
+            'vendor': get_vendor_id(device),
+            'model': device.get('ID_MODEL_ID'),
+            'vendor_name': device.get('ID_VENDOR'),
+            'model_name': device.get('ID_MODEL')}
+
+class DeviceIndex:
+    """Connected USB devices keyed by sysfs path, kept current from udev events"""
+    def __init__(self):
+        self.devices = {}  # sys_path -> {'serial', 'vendor', 'model'}
+        self.lock = threading.Lock()
+    
+    def populate(self, context):
+        """Fill the index once from the current USB tree"""
+        for device in context.list_devices(subsystem='usb', DEVTYPE='usb_device'):
+            self.add(device)
     
-    for device_id, vendor_id in device_snapshot.items():
-        if device_id not in new_snapshot:
-            return device_id, vendor_id
+    def add(self, device):
+        if device.device_type == 'usb_interface':
+            return self.lookup(device.sys_path)
+        info = device_info(device)
+        with self.lock:
+            self.devices[device.sys_path] = info
+        return info
     
-    return 'default', 'N/A'
+    def remove(self, device):
+        """Forget a removed device and return what was known about it"""
+        if device.device_type == 'usb_interface':
+            return self.lookup(device.sys_path)
+        with self.lock:
+            return self.devices.pop(device.sys_path, None)
+    
+    def list(self):
+        with self.lock:
+            return [dict(info, sys_path=sys_path) for sys_path, info in self.devices.items()]
+    
+    def lookup(self, sys_path):
+        """Find the device at sys_path or the closest indexed parent"""
+        with self.lock:
+            while sys_path:
+                if sys_path in self.devices:
+                    return self.devices[sys_path]
+                sys_path = sys_path.rpartition('/')[0]
+        return None
 
-def match_pattern(pattern, text):
-    """Match pattern with wildcard support"""
-    return fnmatch.fnmatch(text, pattern)
+def device_root(device):
+    """The sysfs path of the usb_device an event belongs to"""
+    if device.device_type == 'usb_interface':
+        return device.sys_path.rpartition('/')[0]
+    return device.sys_path
 
-def find_matching_sound(device_id, vendor_id, event_type, config):
-    """Find matching sound with wildcard support"""
-    sound_mappings = config.get('sound_mappings', {})
+class CoalescedEvent:
+    """The udev events of one usb_device and its interfaces"""
+    def __init__(self, action, root, deadline):
+        self.action = action
+        self.root = root
+        self.deadline = deadline
+        self.devices = []
+        self.received = time.monotonic()
+        self.wall_time = datetime.now()
+    
+    @property
+    def device(self):
+        """The event of the usb_device itself, or the first interface seen"""
+        for device in self.devices:
+            if device.sys_path == self.root:
+                return device
+        return self.devices[0]
+    
+    @property
+    def interfaces(self):
+        # A device re-plugged within the settle window shows up more than once; list each path once
+        return list(dict.fromkeys(d.device_path for d in self.devices if d.device_type == 'usb_interface'))
+
+class EventCoalescer:
+    """Merges the usb_interface events of a composite device into the event of its usb_device,
+    so it produces one logical connect/disconnect. Devices behind a hub stay separate events:
+    each of them goes through the blacklist, sound and action rules on its own"""
+    def __init__(self, settle=0.3):
+        self.settle = settle
+        self.pending = OrderedDict()  # (action, root path) -> CoalescedEvent
+    
+    def add(self, device):
+        action = device.action
+        if action not in ('add', 'remove'):
+            return
+        root = device_root(device)
+        # Interfaces are removed before their device, so either may open the event
+        event = self.pending.get((action, root))
+        if event is None:
+            event = self.pending[(action, root)] = CoalescedEvent(action, root, time.monotonic() + self.settle)
+        event.devices.append(device)
+    
+    def next_timeout(self):
+        """Seconds until the next event is due, or None if nothing is pending"""
+        if not self.pending:
+            return None
+        deadline = min(event.deadline for event in self.pending.values())
+        return max(0, deadline - time.monotonic())
+    
+    def pop_due(self):
+        now = time.monotonic()
+        due = [key for key, event in self.pending.items() if event.deadline <= now]
+        return [self.pending.pop(key) for key in due]
+
+class TraceEvent:
+    """A recorded or synthetic udev event offering the parts of pyudev.Device the monitor reads"""
+    __slots__ = ('seq', 'time', 'action', 'sys_path', 'device_path', 'device_type', 'properties')
+    
+    def __init__(self, seq, time, action, device_path, device_type, properties):
+        self.seq = seq
+        self.time = time  # Monotonic seconds when the event was received
+        self.action = action
+        self.device_path = device_path
+        self.sys_path = '/sys' + device_path
+        self.device_type = device_type
+        self.properties = properties
+    
+    def get(self, key, default=None):
+        return self.properties.get(key, default)
+    
+    def to_dict(self):
+        return {'seq': self.seq, 't': round(self.time, 6), 'action': self.action, 'devpath': self.device_path,
+                'devtype': self.device_type, 'props': self.properties}
+    
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['seq'], data['t'], data['action'], data['devpath'], data['devtype'], data['props'])
+
+def read_trace(path):
+    """Load a trace: one JSON object per line as written by TraceEvent.to_dict"""
+    with open(path) as f:
+        return [TraceEvent.from_dict(json.loads(line)) for line in f if line.strip()]
+
+def synthetic_trace(device_count=500, plug_count=5000, seed=7):
+    """Plug/unplug cycles of composite devices: each usb_device arrives with two interfaces"""
+    rng = random.Random(seed)
+    devices = []
+    for i in range(device_count):
+        vendor, model = f"{rng.randrange(0x10000):04x}", f"{rng.randrange(0x10000):04x}"
+        path = f"/devices/pci0000:00/0000:00:14.0/usb{1 + i % 4}/{1 + i % 4}-{1 + i // 4 % 12}.{i // 48 + 1}"
+        devices.append((path, {'ID_SERIAL': f"Vendor{i % 97}_Device_{i:06d}", 'ID_VENDOR_ID': vendor, 'ID_MODEL_ID': model,
+                               'SUBSYSTEM': 'usb', 'DEVTYPE': 'usb_device'}))
+    events = []
+    connected = set()
+    now = 0.0
+    for _ in range(plug_count):
+        index = rng.randrange(device_count)
+        path, properties = devices[index]
+        action = 'remove' if index in connected else 'add'
+        connected.symmetric_difference_update({index})
+        now += rng.expovariate(20)
+        interfaces = [TraceEvent(0, now, action, f"{path}/{path.rpartition('/')[2]}:1.{n}", 'usb_interface',
+                                 dict(properties, DEVTYPE='usb_interface')) for n in range(2)]
+        device = TraceEvent(0, now, action, path, 'usb_device', properties)
+        # The kernel announces interfaces after their device on add, and before it on remove
+        events.extend([device] + interfaces if action == 'add' else interfaces + [device])
+    for seq, event in enumerate(events):
+        event.seq = seq
+    return events
+
+def is_literal(pattern):
+    return not any(c in pattern for c in '*?[')
+
+class WildcardIndex:
+    """Wildcard patterns bucketed by their literal prefix, so a lookup only tests
+    patterns whose prefix the text actually starts with"""
+    def __init__(self, patterns):
+        self.buckets = {}  # Literal prefix -> [(rank, regex, value)]
+        # Rank by specificity: fewer wildcards = higher priority, ties keep config order
+        ranked = sorted(patterns, key=lambda rule: -(len(rule[0]) - rule[0].count('*')))
+        for rank, (pattern, value) in enumerate(ranked):
+            prefix = re.split(r'[*?[]', pattern, 1)[0]
+            regex = re.compile(fnmatch.translate(pattern))
+            self.buckets.setdefault(prefix, []).append((rank, regex, value))
+        self.prefix_lengths = sorted({len(prefix) for prefix in self.buckets})
+    
+    def __bool__(self):
+        return bool(self.buckets)
     
-    # Priority: exact device match > device pattern > vendor match > vendor pattern > wildcard
-    candidates = []
+    def match(self, text):
+        best = None
+        for length in self.prefix_lengths:
+            if length > len(text):
+                break
+            for rank, regex, value in self.buckets.get(text[:length], ()):
+                if (best is None or rank < best[0]) and regex.fullmatch(text):
+                    best = (rank, value)
+                    break  # Buckets are in rank order
+        return best[1] if best else None
+
+class RuleResolver:
+    """Precompiled lookup for rules keyed by device pattern, 'vendor:PATTERN' or '*'"""
+    CACHE_SIZE = 65536
     
-    for pattern, sounds in sound_mappings.items():
-        if event_type not in sounds:
+    def __init__(self, rules):
+        self.devices = {}  # Literal device IDs
+        self.vendors = {}  # Literal vendor IDs
+        self.fallback = None  # The '*' rule
+        self.results = {}  # (device_id, vendor_id) -> value
+        device_patterns = []
+        vendor_patterns = []
+        for pattern, value in rules.items():
+            if pattern.startswith('vendor:'):
+                vendor_pattern = pattern.split(':', 1)[1]
+                if is_literal(vendor_pattern):
+                    self.vendors[vendor_pattern] = value
+                else:
+                    vendor_patterns.append((vendor_pattern, value))
+            elif pattern == '*':
+                self.fallback = value
+            elif is_literal(pattern):
+                self.devices[pattern] = value
+            else:
+                device_patterns.append((pattern, value))
+        self.device_patterns = WildcardIndex(device_patterns)
+        self.vendor_patterns = WildcardIndex(vendor_patterns)
+    
+    def match(self, device_id, vendor_id=None):
+        key = (device_id, vendor_id)
+        if key in self.results:
+            return self.results[key]
+        value = self._resolve(device_id, vendor_id)
+        if len(self.results) >= self.CACHE_SIZE:
+            self.results.clear()
+        self.results[key] = value
+        return value
+    
+    def _resolve(self, device_id, vendor_id):
+        # Priority: exact device > device pattern > vendor match > vendor pattern > wildcard
+        if device_id in self.devices:
+            return self.devices[device_id]
+        if self.device_patterns:
+            value = self.device_patterns.match(device_id)
+            if value is not None:
+                return value
+        if vendor_id:
+            if vendor_id in self.vendors:
+                return self.vendors[vendor_id]
+            if self.vendor_patterns:
+                value = self.vendor_patterns.match(vendor_id)
+                if value is not None:
+                    return value
+        return self.fallback
+
+def rule_sources(config, kind):
+    """The config objects the rules of a kind are built from"""
+    if kind in ('connect', 'disconnect'):
+        return (config.get('sound_mappings', {}),)
+    if kind == 'color':
+        return (config.get('device_colors', {}), config.get('vendor_colors', {}))
+    if kind == 'action':
+        return (config.get('device_actions', {}),)
+    if kind == 'blacklist':
+        return (config.get('blacklist', []),)
+    if kind == 'dedup':
+        return (config.get('dedup_windows', {}),)
+    raise ValueError(f"Unknown rule kind: {kind}")
+
+def build_rules(kind, *sources):
+    if kind in ('connect', 'disconnect'):
+        return {pattern: sounds[kind] for pattern, sounds in sources[0].items() if kind in sounds}
+    if kind == 'color':
+        device_colors, vendor_colors = sources
+        rules = {f"vendor:{vendor}": color for vendor, color in vendor_colors.items()}
+        rules.update(device_colors)
+        return rules
+    if kind == 'blacklist':
+        return {pattern: True for pattern in sources[0]}
+    return dict(sources[0])
+
+def get_resolver(config, kind):
+    """Return the resolver for a rule kind, rebuilding it when its config section changed"""
+    sources = rule_sources(config, kind)
+    cached = resolvers.get(kind)
+    # Cached entries keep references to their sources, so identities cannot be reused
+    if cached and all(a is b for a, b in zip(cached[0], sources)):
+        return cached[1]
+    resolver = RuleResolver(build_rules(kind, *sources))
+    resolvers[kind] = (sources, resolver)
+    return resolver
+
+def invalidate_resolvers():
+    """Drop compiled rules after the config was changed in place"""
+    resolvers.clear()
+
+def find_matching_sound(device_id, vendor_id, event_type, config):
+    """Find matching sound with wildcard support"""
+    return get_resolver(config, event_type).match(device_id, vendor_id)
+
+def find_matching_action(device_id, vendor_id, config):
+    return get_resolver(config, 'action').match(device_id, vendor_id)
+
+def is_blacklisted(device_id, vendor_id, config):
+    return bool(get_resolver(config, 'blacklist').match(device_id, vendor_id))
+
+def get_dedup_window(device_id, vendor_id, config):
+    window = get_resolver(config, 'dedup').match(device_id, vendor_id)
+    return config.get('dedup_window', 0.5) if window is None else window
+
+STARTUP_BUDGET_MS = 100  # Wall time of light commands like 'kg --version'
+STARTUP_COMMANDS = (['--version'], ['colours'])
+STARTUP_HEAVY = {'gi', 'pyudev', 'asyncio'}  # Modules light commands must not import
+
+def profile_startup(command, runs=5):
+    """Run kg with -X importtime; returns (best wall ms, top-level import ms, modules loaded)"""
+    script = os.path.abspath(__file__)
+    best_wall = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', script] + command,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        wall = (time.perf_counter() - start) * 1000
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+    imports = 0
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
             continue
-            
-        if pattern.startswith('vendor:'):
-            vendor_pattern = pattern.split(':', 1)[1]
-            if vendor_id and match_pattern(vendor_id, vendor_pattern):
-                # Calculate specificity (fewer wildcards = higher priority)
-                specificity = len(vendor_pattern) - vendor_pattern.count('*')
-                candidates.append((specificity, sounds[event_type]))
-        elif pattern == '*':
-            candidates.append((0, sounds[event_type]))
+        _, cumulative, name = line.split('|', 2)
+        if not name[1:].startswith(' '):
+            imports += int(cumulative)  # Only top-level imports, nested ones are included
+        loaded.add(name.strip())
+    return best_wall, imports / 1000, loaded
+
+def benchmark_startup(budget_ms=STARTUP_BUDGET_MS, runs=5):
+    """Time light CLI commands with -X importtime and check they stay within budget"""
+    passed = True
+    print(colorize("CLI startup benchmark", Colors.BOLD + Colors.BRIGHT_CYAN))
+    for command in STARTUP_COMMANDS:
+        best_wall, imports, loaded = profile_startup(command, runs)
+        slow = sorted(STARTUP_HEAVY & loaded)
+        ok = best_wall <= budget_ms and not slow
+        passed = passed and ok
+        status = colorize("OK  ", Colors.BRIGHT_GREEN) if ok else colorize("SLOW", Colors.BRIGHT_RED)
+        print(f"  {status} kg {' '.join(command):<12} wall {best_wall:6.1f} ms  imports {imports:6.1f} ms"
+              + (f"  loaded: {', '.join(slow)}" if slow else ""))
+    print(f"  Budget: {budget_ms:.0f} ms wall, no {', '.join(sorted(STARTUP_HEAVY))} imports")
+    return passed
+
+def benchmark_rules(rule_count=10000, event_count=100000):
+    """Time rule compilation and resolution against synthetic rules and events"""
+    rng = random.Random(4)
+    vendors = [f"{rng.randrange(0x10000):04x}" for _ in range(max(1, rule_count // 20))]
+    devices = [(f"Vendor{i % 97}_Device_{i:06d}", rng.choice(vendors)) for i in range(rule_count)]
+    unknown = [(f"Unknown_{i}", rng.choice(vendors)) for i in range(max(1, rule_count // 10))]
+    rules = {}
+    for i, (serial, vendor) in enumerate(devices):
+        kind = i % 10
+        if kind < 7:
+            rules[serial] = {'connect': f"/sounds/{i}.mp3"}
+        elif kind < 9:
+            rules[serial[:rng.randint(8, len(serial) - 2)] + '*'] = {'connect': f"/sounds/{i}.mp3"}
         else:
-            if match_pattern(device_id, pattern):
-                specificity = len(pattern) - pattern.count('*')
-                candidates.append((specificity + 1000, sounds[event_type]))  # Device patterns have higher priority
+            rules[f"vendor:{vendor[:rng.randint(2, 4)]}*"] = {'connect': f"/sounds/{i}.mp3"}
+    rules['*'] = {'connect': '/sounds/default.mp3'}
+    events = [rng.choice(devices) if rng.random() < 0.8 else rng.choice(unknown) for _ in range(event_count)]
     
-    if candidates:
-        candidates.sort(reverse=True, key=lambda x: x[0])
-        return candidates[0][1]
+    start = time.perf_counter()
+    resolver = RuleResolver(build_rules('connect', rules))
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    matched = sum(1 for device_id, vendor_id in events if resolver._resolve(device_id, vendor_id))
+    cold_time = time.perf_counter() - start
+    for device_id, vendor_id in events:
+        resolver.match(device_id, vendor_id)
+    # Second pass: every event is a repeat plug served from the result cache
+    start = time.perf_counter()
+    for device_id, vendor_id in events:
+        resolver.match(device_id, vendor_id)
+    cached_time = time.perf_counter() - start
     
-    return None
+    print(colorize("Rule resolution benchmark", Colors.BOLD + Colors.BRIGHT_CYAN))
+    print(f"  Rules: {len(rules)}  Events: {event_count}  Matched: {matched}")
+    print(f"  Compile:  {build_time * 1000:.1f} ms")
+    print(f"  Resolve:  {cold_time:.3f} s ({cold_time / event_count * 1e6:.2f} µs/event)")
+    print(f"  Memoised: {cached_time:.3f} s ({cached_time / event_count * 1e6:.2f} µs/event)")
 
-def monitor_usb(hide_connects=False, hide_disconnects=False, hide_default=False, hide_devices=False, show_all_duplicates=False):
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+def record_trace(path):
+    """Write every raw usb udev event to a trace file until interrupted"""
     context = pyudev.Context()
     monitor = pyudev.Monitor.from_netlink(context)
     monitor.filter_by('usb')
+    monitor.start()
+    count = 0
+    print(colorize(f"Recording USB events to {path}, press Ctrl+C to stop", Colors.BRIGHT_CYAN))
+    with open(path, 'w') as f:
+        try:
+            while True:
+                device = monitor.poll()
+                # Write a whole burst, then flush once
+                while device is not None:
+                    event = TraceEvent(device.sequence_number, time.monotonic(), device.action, device.device_path,
+                                       device.device_type, dict(device.properties))
+                    f.write(json.dumps(event.to_dict(), separators=(',', ':')) + '\n')
+                    count += 1
+                    device = monitor.poll(timeout=0)
+                f.flush()
+                if debug_mode:
+                    print(f"DEBUG: {count} events recorded")
+        except KeyboardInterrupt:
+            pass
+    print(f"\nRecorded {count} events")
+
+def replay_trace(path, speed=1.0, hide_connects=False, hide_disconnects=False, hide_default=False, hide_devices=False,
+                 show_all_duplicates=False, include_interfaces=False, event_stream=None):
+    """Play a recorded trace through the monitor with the current config.
+    Sounds play, but actions are only counted and history goes to a throwaway database"""
+    events = read_trace(path)
+    runner = NullSink()
+    with scratch_history():
+        daemon = MonitorDaemon(hide_connects, hide_disconnects, hide_default, hide_devices, show_all_duplicates,
+                               include_interfaces, event_stream, udev=False, runner=runner)
+        try:
+            asyncio.run(daemon.run_trace(events, speed))
+        except KeyboardInterrupt:
+            pass
+    print(colorize(f"Replayed {len(events)} events", Colors.BRIGHT_CYAN))
+    print(f"Suppressed duplicate events: {deduplicator.suppressed}")
+    print(f"Actions that would have run: {runner.calls}")
+    for name, stats in daemon.stats().items():
+        if stats['dropped']:
+            print(f"Dropped from {name} queue: {stats['dropped']} (max depth {stats['max_depth']})")
+
+@contextmanager
+def scratch_history():
+    """Send history writes to a throwaway database, so benchmarks and replays leave the real one alone"""
+    global event_log
+    saved_log = event_log
+    with tempfile.TemporaryDirectory() as tmp:
+        event_log = EventLog(os.path.join(tmp, 'history.db'))
+        try:
+            yield event_log
+        finally:
+            event_log.conn.close()
+            event_log = saved_log
+
+def benchmark_pipeline(events=None, rule_count=1000, plug_count=5000, passes=('time', 'memory')):
+    """Push a trace through resolve, log, notify and act with sound and actions stubbed out.
+    History goes to a throwaway database and the config is synthetic unless a trace is replayed"""
+    if events is None:
+        events = synthetic_trace(plug_count=plug_count)
+        rules = {f"Vendor{i % 97}_Device_{i:06d}" if i % 3 else f"Vendor{i % 97}_Device_{i // 10:05d}*": {'connect': f"/sounds/{i}.mp3"}
+                 for i in range(rule_count)}
+        config = dict(load_config(), sound_mappings=rules, device_actions={'Vendor1_*': '/bin/true'})
+    else:
+        config = dict(load_config())
+    # Nothing may be dropped or merged by time; what is measured is the work per event
+    config.update(dedup_window=0, coalesce_window=0, storm_rate=0, event_queue_size=len(events) + 1, history_max_days=0, history_max_events=0)
     
-    # Take initial snapshot
-    take_device_snapshot()
+    results = {}
+    for mode in passes:
+        with scratch_history():
+            sink = open(os.devnull, 'w')
+            daemon = MonitorDaemon(udev=False, config=config, player=NullSink(), runner=NullSink(), event_stream=sink)
+            daemon.latencies = []
+            if mode == 'memory':
+                # 'kg --profile --tracemalloc' may already be tracing; share its tracer
+                tracing = tracemalloc.is_tracing()
+                if not tracing:
+                    tracemalloc.start()
+                if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+                    tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            asyncio.run(daemon.run_trace(events, speed=0))
+            elapsed = time.perf_counter() - start
+            if mode == 'memory':
+                current, peak = tracemalloc.get_traced_memory()
+                if not tracing:
+                    tracemalloc.stop()
+                results['memory'] = {'peak': peak - baseline, 'retained': current - baseline}
+            else:
+                results['time'] = {'elapsed': elapsed, 'records': len(daemon.latencies), 'latencies': daemon.latencies,
+                                   'sounds': sound_player.calls, 'actions': daemon.actions.calls}
+            sink.close()
     
-    def handle_device_event(action, device):
-        config = load_config()
+    print(colorize("Event pipeline benchmark", Colors.BOLD + Colors.BRIGHT_CYAN))
+    if 'time' in results:
+        timing = results['time']
+        latencies = timing['latencies']
+        print(f"  udev events: {len(events)}  Plugs/unplugs: {timing['records']}  Rules: {len(config['sound_mappings'])}")
+        print(f"  Throughput: {len(events) / timing['elapsed']:.0f} udev events/s ({timing['records'] / timing['elapsed']:.0f} plugs/s)")
+        print(f"  Latency:    p50 {percentile(latencies, 0.5) * 1000:.3f} ms  p99 {percentile(latencies, 0.99) * 1000:.3f} ms  "
+              f"max {max(latencies, default=0) * 1000:.3f} ms")
+        print(f"  Sinks:      {timing['sounds']} sounds, {timing['actions']} actions")
+    if 'memory' in results:
+        memory = results['memory']
+        print(f"  Memory:     peak {memory['peak'] / 1024:.0f} KiB, retained {memory['retained'] / 1024:.0f} KiB "
+              f"({memory['peak'] / len(events):.0f} B peak per udev event)")
+    return results
+
+class StackSampler:
+    """Wall-clock sampling profiler: records the stack of every thread at a fixed interval.
+    Unlike cProfile it also sees the sound and history threads, and costs nothing per call"""
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = {}  # 'thread;outer;...;inner' -> samples
+        self.lock = threading.Lock()
+        self.running = False
+        self.thread = None
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        self.running = False
+        self.thread.join()
+    
+    def _sample(self):
+        names = {}
+        own = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ';'.join(reversed(stack))
+                with self.lock:
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+            time.sleep(self.interval)
+    
+    def write(self, path):
+        """Collapsed stacks, one 'frame;frame;... count' line each, as flamegraph.pl and speedscope read them"""
+        with self.lock:
+            stacks = sorted(self.stacks.items())
+        with open(path, 'w') as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+        return stacks
+
+class Profiler:
+    """Profiles a command with cProfile (pstats output) or StackSampler (collapsed stacks),
+    optionally with tracemalloc snapshots. dump() may be called at any time, e.g. from SIGUSR1"""
+    def __init__(self, path, mode='cprofile', trace_memory=False):
+        self.path = path
+        self.mode = mode
+        self.trace_memory = trace_memory
+        self.profile = None
+        self.sampler = None
+        self.snapshot = None  # Previous tracemalloc snapshot, to show what grew since
+    
+    def start(self):
+        if self.trace_memory:
+            tracemalloc.start(10)
+        if self.mode == 'sample':
+            self.sampler = StackSampler()
+            self.sampler.start()
+        else:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+    
+    def stop(self):
+        if self.sampler:
+            self.sampler.stop()
+        else:
+            self.profile.disable()
+        self.dump(final=True)
+        if self.trace_memory:
+            tracemalloc.stop()
+    
+    def dump(self, final=False):
+        out = sys.stderr  # stdout may be carrying --format jsonl
+        if self.trace_memory:
+            # Taken first, so writing the profile does not show up in it
+            snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+            snapshot.dump(self.path + '.tracemalloc')
+            if self.snapshot is None:
+                top, title = snapshot.statistics('lineno'), "Largest allocation sites"
+            else:
+                top, title = snapshot.compare_to(self.snapshot, 'lineno'), "Allocation growth since the last dump"
+            self.snapshot = snapshot
+            print(colorize(title, Colors.BOLD), file=out)
+            for stat in top[:10]:
+                print(f"  {stat}", file=out)
+            print(colorize(f"Allocation snapshot written to {self.path}.tracemalloc", Colors.BRIGHT_CYAN), file=out)
+        if self.sampler:
+            stacks = self.sampler.write(self.path)
+            if final:
+                leaves = {}
+                for stack, count in stacks:
+                    leaf = stack.rsplit(';', 1)[-1]
+                    leaves[leaf] = leaves.get(leaf, 0) + count
+                total = sum(leaves.values()) or 1
+                print(colorize("Most sampled frames", Colors.BOLD), file=out)
+                for leaf, count in sorted(leaves.items(), key=lambda x: x[1], reverse=True)[:15]:
+                    print(f"  {count / total:6.1%}  {leaf}", file=out)
+        else:
+            # Stats cannot be taken while the profiler is collecting
+            running = not final
+            if running:
+                self.profile.disable()
+            self.profile.dump_stats(self.path)
+            if running:
+                self.profile.enable()
+            if final:
+                pstats.Stats(self.path, stream=out).sort_stats('cumulative').print_stats(15)
+        print(colorize(f"Profile written to {self.path}", Colors.BRIGHT_CYAN), file=out)
+
+@contextmanager
+def profiling(path, mode='cprofile', trace_memory=False):
+    """Profile the enclosed code; SIGUSR1 writes the profile so far without stopping"""
+    profiler = Profiler(path, mode, trace_memory)
+    previous = signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.dump())
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        signal.signal(signal.SIGUSR1, previous)
+
+def control_dir_ok(create=False):
+    """Whether CONTROL_DIR belongs to this user and nobody else can write to it"""
+    if create and not os.environ.get('XDG_RUNTIME_DIR'):
+        try:
+            os.mkdir(CONTROL_DIR, 0o700)
+        except FileExistsError:
+            pass
+    try:
+        st = os.lstat(CONTROL_DIR)
+    except FileNotFoundError:
+        return False
+    return os.path.isdir(CONTROL_DIR) and not os.path.islink(CONTROL_DIR) and st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+def daemon_request(method, params=None, timeout=2):
+    """Call the running daemon's control socket; returns None if no daemon answers"""
+    if not control_dir_ok():
+        return None  # A socket someone else could have put there is not our daemon
+    request = json.dumps({'id': 1, 'method': method, 'params': params or {}}).encode() + b'\n'
+    data = b''
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(CONTROL_SOCKET)
+            sock.sendall(request)
+            while not data.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                data += chunk
+    except OSError:
+        return None
+    if not data:
+        return None
+    response = json.loads(data)
+    if 'error' in response:
+        raise RuntimeError(response['error']['message'])
+    return response.get('result')
+
+class ControlServer:
+    """JSON-RPC style request/response API of the running daemon on a Unix socket"""
+    def __init__(self, path=CONTROL_SOCKET):
+        self.path = path
+        self.methods = {}
+        self.blocking = set()  # Methods that run on a thread instead of the event loop
+        self.server = None
+    
+    def register(self, name, handler, blocking=False):
+        """blocking=True for handlers that query SQLite or walk sysfs, so udev reception never waits for them"""
+        self.methods[name] = handler
+        if blocking:
+            self.blocking.add(name)
+    
+    async def start(self):
+        if not control_dir_ok(create=True):
+            print(colorize(f"Warning: {CONTROL_DIR} is not private to this user; config commands will not reach the monitor", Colors.YELLOW))
+            return False
+        if daemon_request('ping', timeout=0.5) is not None:
+            print(colorize(f"Warning: another Knocking Goose already owns {self.path}", Colors.YELLOW))
+            return False
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.server = await asyncio.start_unix_server(self._handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        return True
+    
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+    
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(json.dumps(await self.dispatch(line)).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    
+    async def dispatch(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'id': None, 'error': {'code': -32700, 'message': 'Parse error'}}
+        handler = self.methods.get(request.get('method'))
+        if handler is None:
+            return {'id': request.get('id'), 'error': {'code': -32601, 'message': f"Unknown method: {request.get('method')}"}}
+        params = request.get('params', {})
+        try:
+            if request['method'] in self.blocking:
+                result = await asyncio.get_running_loop().run_in_executor(None, lambda: handler(**params))
+            else:
+                result = handler(**params)
+            return {'id': request.get('id'), 'result': result}
+        except Exception as e:
+            return {'id': request.get('id'), 'error': {'code': -32000, 'message': str(e)}}
+
+class Histogram:
+    """Latency histogram: cumulative buckets for Prometheus plus the latest samples for percentiles"""
+    BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+               0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Seconds
+    LABELS = [repr(bound) for bound in BUCKETS] + ['+Inf']
+    WINDOW = 1024  # Samples the percentiles are computed over
+    
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)  # The last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=self.WINDOW)
+    
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+    
+    def summary(self):
+        recent = list(self.recent)
+        return {'count': self.count, 'mean': self.sum / self.count if self.count else 0.0,
+                'p50': percentile(recent, 0.5), 'p99': percentile(recent, 0.99), 'max': max(recent, default=0.0)}
+
+class Metrics:
+    """Per-stage latencies and counters of the monitor. Only created when metrics are enabled;
+    every call site checks for None first, so a disabled monitor pays one attribute test per stage"""
+    STAGES = ('receive', 'config', 'identify', 'dedup', 'rules', 'log', 'notify', 'sound_start', 'action_spawn', 'total')
+    COUNTERS = ('udev_events', 'events', 'duplicates', 'blacklisted', 'sounds_played', 'sounds_dropped',
+                'playback_failures', 'actions_run', 'action_failures', 'actions_debounced', 'storms', 'storm_events')
+    
+    def __init__(self):
+        self.started = time.time()
+        self.histograms = {stage: Histogram() for stage in self.STAGES}
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        # Sound workers and the log thread report from outside the event loop
+        self.lock = threading.Lock()
+    
+    def observe(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].observe(seconds)
+    
+    def lap(self, stage, start):
+        """Record the time since start for a stage and return now, the start of the next one"""
+        now = time.perf_counter()
+        self.observe(stage, now - start)
+        return now
+    
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+    
+    def snapshot(self, queues=None):
+        with self.lock:
+            return {'uptime': time.time() - self.started,
+                    'counters': dict(self.counters),
+                    'stages': {stage: hist.summary() for stage, hist in self.histograms.items()},
+                    'queues': queues or {}}
+    
+    def prometheus(self, queues=None):
+        """The metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            for name, value in self.counters.items():
+                lines += [f"# TYPE kg_{name}_total counter", f"kg_{name}_total {value}"]
+            lines.append("# TYPE kg_stage_seconds histogram")
+            for stage, hist in self.histograms.items():
+                cumulative = 0
+                for bound, count in zip(Histogram.LABELS, hist.counts):
+                    cumulative += count
+                    lines.append(f'kg_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'kg_stage_seconds_sum{{stage="{stage}"}} {hist.sum}')
+                lines.append(f'kg_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+        if queues:
+            lines.append("# TYPE kg_queue_depth gauge")
+            lines += [f'kg_queue_depth{{queue="{name}"}} {stats["depth"]}' for name, stats in queues.items()]
+            lines.append("# TYPE kg_queue_dropped_total counter")
+            lines += [f'kg_queue_dropped_total{{queue="{name}"}} {stats["dropped"]}' for name, stats in queues.items()]
+        lines.append("# TYPE kg_uptime_seconds gauge")
+        lines.append(f"kg_uptime_seconds {time.time() - self.started:.0f}")
+        return "\n".join(lines) + "\n"
+
+class StageQueue:
+    """Bounded queue between daemon stages that drops instead of blocking the producer"""
+    def __init__(self, name, maxsize=256, policy='drop-oldest'):
+        self.name = name
+        self.queue = asyncio.Queue(maxsize)
+        self.policy = policy
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_depth = 0
+    
+    def put(self, item):
+        if self.queue.full():
+            self.dropped += 1
+            if debug_mode:
+                print(f"DEBUG: {self.name} queue full, dropping {'oldest' if self.policy == 'drop-oldest' else 'newest'} event")
+            if self.policy != 'drop-oldest':
+                return False
+            self.queue.get_nowait()
+            self.queue.task_done()
+        self.queue.put_nowait(item)
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+        return True
+    
+    async def get(self):
+        return await self.queue.get()
+    
+    def done(self):
+        self.queue.task_done()
+    
+    def stats(self):
+        return {'depth': self.queue.qsize(), 'max_depth': self.max_depth,
+                'enqueued': self.enqueued, 'dropped': self.dropped}
+
+def write_jsonl(obj, stream=None):
+    """One compact JSON object per line, flushed so readers like jq see it at once"""
+    stream = stream or sys.stdout
+    stream.write(json.dumps(obj, separators=(',', ':'), default=str) + '\n')
+    stream.flush()
+
+class EventBroadcaster:
+    """Fans identified events out to the session clients of a system-wide monitor"""
+    MAX_BACKLOG = 256 * 1024  # Bytes a client may fall behind before it is disconnected
+    
+    def __init__(self, path=SYSTEM_SOCKET):
+        self.path = path
+        self.clients = set()
+        self.server = None
+    
+    async def start(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.server = await asyncio.start_unix_server(self._accept, path=self.path)
+        # Every session user may listen; nothing can be sent back
+        os.chmod(self.path, 0o666)
+    
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in self.clients:
+                writer.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+    
+    async def _accept(self, reader, writer):
+        self.clients.add(writer)
+        if debug_mode:
+            print(f"DEBUG: Session client connected ({len(self.clients)} total)")
+        try:
+            # Clients have nothing to say; discard anything sent until they go away
+            while await reader.read(4096):
+                pass
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+    
+    def send(self, event):
+        if not self.clients:
+            return
+        line = json.dumps(event, separators=(',', ':'), default=str).encode() + b'\n'
+        for writer in list(self.clients):
+            if writer.transport.get_write_buffer_size() > self.MAX_BACKLOG:
+                print(colorize("Warning: dropping a session client that stopped reading", Colors.YELLOW))
+                self.clients.discard(writer)
+                writer.close()
+            else:
+                writer.write(line)
+
+class NullSink:
+    """Counts what would have been played or run; stands in for the sound player or action runner"""
+    def __init__(self):
+        self.calls = 0
+    
+    def play(self, *args):
+        self.calls += 1
+    
+    def clear(self):
+        pass
+    
+    def submit(self, *args):
+        self.calls += 1
+
+class MonitorDaemon:
+    """asyncio monitor: udev reception feeds resolve, log, notify and act stages
+    through bounded queues, so a slow disk or audio device never stalls reception"""
+    def __init__(self, hide_connects=False, hide_disconnects=False, hide_default=False, hide_devices=False, show_all_duplicates=False, include_interfaces=False, event_stream=None,
+                 udev=True, config=None, player=None, runner=None, role='local', metrics=False):
+        """udev=False builds the pipeline without a netlink socket, to be fed by replay();
+        config, player and runner replace the config file, SoundPlayer and ActionRunner.
+        metrics=True times every stage like the 'metrics' config key does.
+        role 'system' does the udev work and history once for all users and broadcasts the events,
+        role 'client' takes them from the system monitor and only applies this user's rules"""
+        global config_cache, sound_player, device_index, deduplicator
+        self.role = role
+        if role == 'system':
+            # Root plays no audio and runs no user scripts; the session clients do
+            player = player or NullSink()
+            runner = runner or NullSink()
+        elif role == 'client':
+            udev = False
+        self.broadcaster = EventBroadcaster() if role == 'system' else None
+        self.event_stream = event_stream  # Write events as JSON lines here instead of printing them
+        self.hide_connects = hide_connects
+        self.hide_disconnects = hide_disconnects
+        self.hide_default = hide_default
+        self.hide_devices = hide_devices
+        self.show_all_duplicates = show_all_duplicates
+        
+        config_cache = ConfigCache(config)
+        deduplicator = EventDeduplicator()
+        config = config_cache.get()
+        if player is None:
+            sound_cache = SoundCache(config.get('sound_cache_mb', 32) * 1024 * 1024)
+            player = SoundPlayer(config.get('sound_overlap', 'queue'),
+                                 config.get('sound_pool_size', 3),
+                                 config.get('sound_timeout', 10),
+                                 sound_cache)
+            # Decode configured sounds up front so the first plug is not a cache miss
+            threading.Thread(target=sound_cache.preload, args=(configured_sounds(config),), daemon=True).start()
+        sound_player = player
+        if role == 'system':
+            # Create the shared history and its schema now; clients only read it
+            get_event_log()
+        
+        device_index = DeviceIndex()
+        self.monitor = None
+        if udev:
+            self.context = pyudev.Context()
+            self.monitor = pyudev.Monitor.from_netlink(self.context)
+            # These filters are compiled into the socket's BPF program, so the kernel drops
+            # unwanted events before they ever wake up this process
+            if include_interfaces:
+                self.monitor.filter_by('usb')
+            else:
+                self.monitor.filter_by('usb', 'usb_device')
+            for tag in config.get('udev_tags', []):
+                self.monitor.filter_by_tag(tag)
+            # One enumeration at startup; afterwards the index follows the events
+            device_index.populate(self.context)
+        self.include_interfaces = include_interfaces
+        
+        # Only interface events are merged; without them, waiting would just delay every notification
+        self.coalescer = EventCoalescer(config.get('coalesce_window', 0.3) if include_interfaces else 0)
+        self.flush_handle = None
+        self.storms = StormDetector(config.get('storm_rate', 5.0), config.get('storm_burst', 4),
+                                    config.get('storm_device_rate', 1.0), config.get('storm_device_burst', 6))
+        self.storm_log = []  # History of the current storm, written in batches
+        self.storm_handle = None
+        self.queue_size = config.get('event_queue_size', 256)
+        self.queue_policy = config.get('event_queue_policy', 'drop-oldest')
+        self.queues = {}  # Stage queues and the history thread exist while run() or run_trace() runs
+        self.log_executor = None
+        self.actions = runner or ActionRunner(config.get('action_concurrency', 4), self._record_action)
+        self.metrics = Metrics() if metrics or config.get('metrics', False) else None
+        self.metrics_port = config.get('metrics_port', 0)
+        self.metrics_server = None
+        player.metrics = self.actions.metrics = self.metrics
+        self.control = ControlServer()
+        self.muted = False
+        self.latencies = None  # A list collects reception-to-announcement times (benchmarks)
+        self.control.register('ping', lambda: 'pong')
+        self.control.register('config.mutate', self.mutate_config)
+        # A client has no index of its own; listing then walks sysfs like 'kg list' without a monitor
+        self.control.register('devices.list', enumerate_devices if role == 'client' else device_index.list, blocking=True)
+        self.control.register('history', recent_events, blocking=True)
+        self.control.register('stats', compute_report, blocking=True)
+        self.control.register('reload', self.reload)
+        self.control.register('mute', self.mute)
+        self.control.register('volume', lambda: config_cache.get().get('volume', 100))
+        self.control.register('metrics', self.metrics_snapshot)
+    
+    def open_pipeline(self):
+        """Create the stage queues and the history thread. Called on the running loop:
+        before Python 3.10 an asyncio.Queue binds to the loop current when it is created"""
+        self.queues = {name: StageQueue(name, self.queue_size, self.queue_policy) for name in ('resolve', 'log', 'notify', 'act')}
+        # History writes stay ordered on one thread off the event loop
+        self.log_executor = concurrent_futures.ThreadPoolExecutor(max_workers=1)
+    
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.open_pipeline()
+        await self.control.start()
+        if self.metrics and self.metrics_port:
+            await self.serve_metrics(self.metrics_port)
+        if self.role == 'client':
+            source = asyncio.ensure_future(self.follow_system())
+        else:
+            if self.broadcaster:
+                await self.broadcaster.start()
+            self.monitor.start()
+            loop.add_reader(self.monitor.fileno(), self._receive)
+        # 'systemctl stop' and logout send SIGTERM; stop like Ctrl+C so the cleanup below
+        # removes the socket and saves the storm history
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            await self.stages()
+        finally:
+            loop.remove_signal_handler(signal.SIGTERM)
+            if self.role == 'client':
+                source.cancel()
+            else:
+                loop.remove_reader(self.monitor.fileno())
+            if self.broadcaster:
+                self.broadcaster.close()
+            if self.metrics_server:
+                self.metrics_server.close()
+            self.control.close()
+            self._save_storm_log()
+            self.log_executor.shutdown(wait=True)
+    
+    async def follow_system(self, path=SYSTEM_SOCKET):
+        """Client role: queue the system monitor's events, reconnecting whenever it restarts"""
+        delay = 1
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(path)
+            except OSError:
+                if delay == 1:
+                    print(colorize(f"Waiting for the system monitor at {path}...", Colors.YELLOW))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+                continue
+            if delay > 1 or debug_mode:
+                print(colorize("Connected to the system monitor", Colors.BRIGHT_GREEN))
+            delay = 1
+            try:
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    event = json.loads(line)
+                    event['wall_time'] = datetime.fromisoformat(event['wall_time'])
+                    self.queues['resolve'].put(event)
+            except (ConnectionError, ValueError) as e:
+                print(f"Error reading from the system monitor: {e}")
+            finally:
+                writer.close()
+    
+    async def stages(self):
+        await asyncio.gather(self._resolve_stage(), self._log_stage(), self._notify_stage(), self._act_stage())
+    
+    async def replay(self, events, speed=1.0):
+        """Feed trace events into the pipeline, keeping their spacing divided by speed (0 = no waiting)"""
+        if not self.include_interfaces:
+            # What the kernel filter would have dropped
+            events = [event for event in events if event.device_type == 'usb_device']
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first = events[0].time if events else 0
+        for i, event in enumerate(events):
+            if speed:
+                delay = start + (event.time - first) / speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.coalescer.add(event)
+            # Events of one plug share a timestamp; let the stages run between plugs
+            if i + 1 == len(events) or events[i + 1].time != event.time:
+                self._schedule_flush()
+                await asyncio.sleep(0)
+    
+    async def run_trace(self, events, speed=1.0):
+        """Run the stages without a udev socket or control server until a whole trace went through"""
+        self.open_pipeline()
+        stages = asyncio.ensure_future(self.stages())
+        try:
+            await self.replay(events, speed)
+            await self.drain()
+        finally:
+            stages.cancel()
+            self._save_storm_log()
+            # Stage coroutines may still hold history writes; finish them before the log is closed
+            await asyncio.get_running_loop().run_in_executor(None, self.log_executor.shutdown)
+    
+    async def drain(self):
+        """Wait until every event handed to the pipeline has gone through all stages"""
+        while self.coalescer.pending:
+            await asyncio.sleep(self.coalescer.next_timeout() or 0)
+        await self.queues['resolve'].queue.join()
+        # A storm still going on is summarized once the rate has dropped
+        while self.storm_handle is not None:
+            await asyncio.sleep(0.1)
+        for name in ('log', 'notify', 'act'):
+            await self.queues[name].queue.join()
+    
+    def reload(self):
+        config_cache.invalidate()
+        invalidate_resolvers()
+        config_cache.get()
+        return "Configuration reloaded"
+    
+    def mute(self, muted=True):
+        """Silence notification sounds until unmuted or restarted; the config is not touched"""
+        self.muted = muted
+        return "Sounds muted" if muted else "Sounds unmuted"
+    
+    def mutate_config(self, op, args):
+        """Apply a CLI config change to the in-memory config and persist it"""
+        with config_lock():
+            config = config_cache.get()
+            changed, message = CONFIG_MUTATIONS[op](config, **args)
+            if changed:
+                config_cache.save(config)
+                invalidate_resolvers()
+        return message
+    
+    def stats(self):
+        return {name: q.stats() for name, q in self.queues.items()}
+    
+    def metrics_snapshot(self, prometheus=False):
+        if not self.metrics:
+            return {'enabled': False}
+        if prometheus:
+            return {'enabled': True, 'text': self.metrics.prometheus(self.stats())}
+        return dict(self.metrics.snapshot(self.stats()), enabled=True)
+    
+    async def serve_metrics(self, port):
+        """Prometheus text endpoint on localhost; any request path gets the metrics"""
+        try:
+            self.metrics_server = await asyncio.start_server(self._metrics_http, '127.0.0.1', port)
+        except OSError as e:
+            print(colorize(f"Warning: cannot serve metrics on port {port}: {e}", Colors.YELLOW))
+    
+    async def _metrics_http(self, reader, writer):
+        try:
+            # Skip the request head; there is only one thing to answer with
+            while (await reader.readline()).strip():
+                pass
+            body = self.metrics.prometheus(self.stats()).encode()
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         + f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    def _receive(self):
+        m = self.metrics
+        if m:
+            start = time.perf_counter()
+        received = 0
+        # Drain everything the socket has so one wakeup handles a whole burst
+        while True:
+            device = self.monitor.poll(timeout=0)
+            if device is None:
+                break
+            self.coalescer.add(device)
+            received += 1
+        self._schedule_flush()
+        if m:
+            m.lap('receive', start)
+            m.count('udev_events', received)
+    
+    def _schedule_flush(self):
+        timeout = self.coalescer.next_timeout()
+        if timeout is None or self.flush_handle is not None:
+            return
+        self.flush_handle = asyncio.get_running_loop().call_later(timeout, self._flush)
+    
+    def _flush(self):
+        self.flush_handle = None
+        for event in self.coalescer.pop_due():
+            self.queues['resolve'].put(event)
+        self._schedule_flush()
+    
+    async def _resolve_stage(self):
+        while True:
+            event = await self.queues['resolve'].get()
+            try:
+                record = self.resolve(event)
+            except Exception as e:
+                print(f"Error handling device event: {e}")
+                record = None
+            if record and not self.storms.admit(record):
+                self._storm_record(record)
+                self.queues['act'].put(record)
+            elif record:
+                # The system monitor keeps the history for its session clients
+                for name in ('notify', 'act') if self.role == 'client' else ('log', 'notify', 'act'):
+                    self.queues[name].put(record)
+            self.queues['resolve'].done()
+    
+    def _storm_record(self, record):
+        """Batch a record into the storm instead of announcing and logging it on its own"""
+        m = self.metrics
+        if m:
+            m.count('storm_events')
+        if self.role != 'client':
+            self.storm_log.append({'timestamp': record['wall_time'].isoformat(), 'device': record['device'],
+                                   'action': record['action'], 'vendor': record['vendor']})
+        if self.storm_handle is None:
+            # The first batched record starts the storm
+            if m:
+                m.count('storms')
+            storm = self.storms.storm
+            self.queues['notify'].put({'type': 'storm', 'state': 'start', 'scope': storm['scope'],
+                                       'time': storm['time'], 'received': storm['monotonic'], 'color': storm['color']})
+            self._check_storm()
+    
+    def _save_storm_log(self):
+        """On shutdown, write what a storm still holds back"""
+        if self.storm_log:
+            self.log_executor.submit(log_events, self.storm_log)
+            self.storm_log = []
+    
+    def _check_storm(self):
+        """Flush the storm's history every second and end it once the rate has dropped"""
+        loop = asyncio.get_running_loop()
+        if self.storm_log:
+            batch, self.storm_log = self.storm_log, []
+            self.queues['log'].put({'type': 'storm', 'events': batch})
+        now = time.monotonic()
+        wait = self.storms.time_to_recover(now)
+        if wait > 0:
+            self.storm_handle = loop.call_later(min(wait, 1.0), self._check_storm)
+            return
+        self.storm_handle = None
+        storm = self.storms.end(now)
+        self.queues['notify'].put(dict(storm, type='storm', state='end', received=now, started=storm['time'], time=datetime.now()))
+    
+    def resolve(self, event):
+        """Identify the device behind a coalesced event and match it against the rules"""
+        m = self.metrics
+        if m:
+            m.count('events')
+        if self.role == 'client':
+            identified = event
+        elif m:
+            start = time.perf_counter()
+            identified = self.identify(event)
+            m.lap('identify', start)
+        else:
+            identified = self.identify(event)
+        # Clients get everything but the system blacklist; their own dedup_windows and flags apply there
+        if self.broadcaster and not is_blacklisted(identified['device'], identified['vendor'], config_cache.get()):
+            self.broadcaster.send(identified)
+        return self.match_rules(identified)
+    
+    def identify(self, event):
+        """What happened to which device, independent of any user's rules"""
+        action = event.action
+        device = event.device
         device_id = device.get('ID_SERIAL', 'default')
         vendor_id = get_vendor_id(device)
+        model_id = device.get('ID_MODEL_ID')
         
-        # For disconnect events, try to identify the device
-        if action == 'remove' and device_id == 'default':
-            device_id, vendor_id = find_disconnected_device()
+        if action == 'add':
+            device_index.add(device)
+        else:
+            # Remove events often lack ID_SERIAL; the index knows what lived at this path
+            info = device_index.remove(device)
+            if device_id == 'default' and info:
+                device_id, vendor_id, model_id = info['serial'], info['vendor'], info['model']
         
         if debug_mode:
-            print(f"DEBUG: Action={action}, Device={device_id}, Vendor={vendor_id}")
+            print(f"DEBUG: Action={action}, Device={device_id}, Vendor={vendor_id}, Events={len(event.devices)}")
         
-        if device_id in config.get('blacklist', []):
-            return
-        if hide_default and device_id == 'default':
-            return
-        if hide_devices and device_id != 'default':
-            return
-        if not show_all_duplicates and is_duplicate_event(action, device_id):
-            return
+        return {
+            'action': action,
+            'device': device_id,
+            'vendor': vendor_id,
+            'model': model_id,
+            'devpath': device.device_path,
+            'interfaces': event.interfaces,
+            'received': event.received,
+            'wall_time': event.wall_time,
+        }
+    
+    def match_rules(self, identified):
+        """Apply the filters and rules of this monitor's config to an identified event"""
+        m = self.metrics
+        if m:
+            start = time.perf_counter()
+        config = config_cache.get()
+        if m:
+            start = m.lap('config', start)
+        action = identified['action']
+        device_id = identified['device']
+        vendor_id = identified['vendor']
         
-        color = get_device_color(device_id, vendor_id, config)
+        if is_blacklisted(device_id, vendor_id, config):
+            if m:
+                m.count('blacklisted')
+            return None
+        if self.hide_default and device_id == 'default':
+            return None
+        if self.hide_devices and device_id != 'default':
+            return None
+        if not self.show_all_duplicates:
+            if m:
+                dedup_start = time.perf_counter()
+            duplicate = deduplicator.is_duplicate(action, device_id, get_dedup_window(device_id, vendor_id, config))
+            if m:
+                # The rule timing goes on after the dedup check, without it
+                start += m.lap('dedup', dedup_start) - dedup_start
+            if duplicate:
+                if m:
+                    m.count('duplicates')
+                if debug_mode:
+                    print(f"DEBUG: Suppressed duplicate ({deduplicator.suppressed} total)")
+                return None
         
-        if action == 'add':
-            if not hide_connects:
-                print(colorize(f"● USB device connected: {device_id}", color))
-                if vendor_id:
-                    print(colorize(f"  ├─ Vendor ID: {vendor_id}", Colors.DIM + color))
-            
-            log_event(device_id, 'add', vendor_id)
-            take_device_snapshot()  # Update snapshot
-            
-            sound_file = find_matching_sound(device_id, vendor_id, 'connect', config)
-            if sound_file:
-                play_sound(sound_file, config.get('volume', 100))
-            
-            if device_id in config.get('device_actions', {}):
-                run_action(config['device_actions'][device_id], device_id)
+        record = dict(identified,
+                      color=get_device_color(device_id, vendor_id, config),
+                      sound=find_matching_sound(device_id, vendor_id, 'connect' if action == 'add' else 'disconnect', config),
+                      script=find_matching_action(device_id, vendor_id, config) if action == 'add' else None,
+                      volume=config.get('volume', 100))
+        if m:
+            m.lap('rules', start)
+        return record
+    
+    async def _log_stage(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            record = await self.queues['log'].get()
+            await loop.run_in_executor(self.log_executor, self._log, record)
+            self.queues['log'].done()
+    
+    def _log(self, record):
+        m = self.metrics
+        if m:
+            start = time.perf_counter()
+        try:
+            if record.get('type') == 'storm':
+                log_events(record['events'])
+            else:
+                log_event(record['device'], record['action'], record['vendor'], record['wall_time'].isoformat())
+        except Exception as e:
+            print(f"Error logging event: {e}")
+        if m:
+            m.lap('log', start)
+    
+    async def _notify_stage(self):
+        while True:
+            record = await self.queues['notify'].get()
+            m = self.metrics
+            if m:
+                start = time.perf_counter()
+            storm = record.get('type') == 'storm'
+            try:
+                if storm:
+                    self.notify_storm(record)
+                else:
+                    self.notify(record)
+            except Exception as e:
+                print(f"Error notifying: {e}")
+            if m and not storm:
+                m.lap('notify', start)
+                m.observe('total', time.monotonic() - record['received'])
+            if self.latencies is not None and not storm:
+                self.latencies.append(time.monotonic() - record['received'])
+            self.queues['notify'].done()
+    
+    def notify(self, record):
+        if self.event_stream:
+            self.emit(record)
         else:
-            if not hide_disconnects:
-                print(colorize(f"○ USB device disconnected: {device_id}", Colors.DIM + color))
-                if vendor_id and vendor_id != 'N/A':
-                    print(colorize(f"  ├─ Vendor ID: {vendor_id}", Colors.DIM + color))
-            
-            log_event(device_id, 'remove', vendor_id)
-            
-            sound_file = find_matching_sound(device_id, vendor_id, 'disconnect', config)
-            if sound_file:
-                play_sound(sound_file, config.get('volume', 100))
+            self.print_event(record)
+        if record['sound'] and not self.muted:
+            sound_player.play(record['sound'], record['volume'])
+    
+    def notify_storm(self, storm):
+        """Storm transitions: a line when it starts, one summary and one sound when it ends"""
+        if self.event_stream:
+            event = {'type': 'storm', 'state': storm['state'], 'monotonic': storm['received'],
+                     'time': storm['time'].isoformat(), 'scope': storm['scope']}
+            if storm['state'] == 'end':
+                event.update(started=storm['started'].isoformat(), summary=storm['summary'], events=storm['events'],
+                             duration=round(storm['duration'], 3),
+                             devices={device: counts['add'] + counts['remove'] for device, counts in storm['devices'].items()})
+            write_jsonl(event, self.event_stream)
+        elif storm['state'] == 'start':
+            what = "USB event storm" if storm['scope'] == 'global' else "Device flapping"
+            print(colorize(f"⚡ {what}, batching notifications...", Colors.BOLD + Colors.BRIGHT_YELLOW))
+        if storm['state'] == 'start':
+            # The events before the storm began are in its summary; one sound at the end is enough
+            sound_player.clear()
+        else:
+            print(colorize(f"⚡ {storm['summary']} ({storm['events']} events in {storm['duration']:.1f}s)",
+                           Colors.BOLD + Colors.BRIGHT_YELLOW))
+        if storm['state'] == 'end' and not self.muted:
+            sound = config_cache.get().get('storm_sound') or storm['sound']
+            if sound:
+                sound_player.play(sound, config_cache.get().get('volume', 100))
+    
+    def emit(self, record):
+        if self.hide_connects if record['action'] == 'add' else self.hide_disconnects:
+            return
+        write_jsonl({
+            'monotonic': record['received'],
+            'time': record['wall_time'].isoformat(),
+            'action': record['action'],
+            'devpath': record['devpath'],
+            'serial': record['device'],
+            'vendor': record['vendor'],
+            'model': record['model'],
+            'interfaces': record['interfaces'],
+            'sound': record['sound'],
+            'script': record['script'],
+            'latency_ms': round((time.monotonic() - record['received']) * 1000, 3),
+        }, self.event_stream)
+    
+    def print_event(self, record):
+        color = record['color']
+        if record['action'] == 'add':
+            if not self.hide_connects:
+                print(colorize(f"● USB device connected: {record['device']}", color))
+                if record['vendor']:
+                    print(colorize(f"  ├─ Vendor ID: {record['vendor']}", Colors.DIM + color))
+        elif not self.hide_disconnects:
+            print(colorize(f"○ USB device disconnected: {record['device']}", Colors.DIM + color))
+            if record['vendor'] and record['vendor'] != 'N/A':
+                print(colorize(f"  ├─ Vendor ID: {record['vendor']}", Colors.DIM + color))
+    
+    async def _act_stage(self):
+        while True:
+            record = await self.queues['act'].get()
+            if record['script']:
+                config = config_cache.get()
+                self.actions.submit(record, config.get('action_timeout', 30), config.get('action_debounce', 2.0))
+            self.queues['act'].done()
+    
+    def _record_action(self, result):
+        asyncio.get_running_loop().run_in_executor(self.log_executor, record_action, result)
+
+def mutate_sound(config, device_name, sound_path, connect=True, disconnect=False):
+    mapping = config['sound_mappings'].setdefault(device_name, {})
+    messages = []
+    if connect:
+        mapping['connect'] = sound_path
+        messages.append(f"Connect sound for '{device_name}' set to: {sound_path}")
+    if disconnect:
+        mapping['disconnect'] = sound_path
+        messages.append(f"Disconnect sound for '{device_name}' set to: {sound_path}")
+    return True, "\n".join(messages)
+
+def mutate_color(config, device_name, color_name):
+    if device_name.startswith('vendor:'):
+        vendor_id = device_name.split(':', 1)[1]
+        config['vendor_colors'][vendor_id] = color_name.lower()
+        return True, f"Color for vendor '{vendor_id}' set to: {colorize(color_name, Colors.get_color(color_name))}"
+    config['device_colors'][device_name] = color_name.lower()
+    return True, f"Color for '{device_name}' set to: {colorize(color_name, Colors.get_color(color_name))}"
+
+def mutate_action(config, device_name, script_path):
+    config['device_actions'][device_name] = script_path
+    return True, f"Action for '{device_name}' set to: {script_path}"
 
-    for device in iter(monitor.poll, None):
-        if device.action == 'add':
-            handle_device_event('add', device)
-        elif device.action == 'remove':
-            handle_device_event('remove', device)
+def mutate_blacklist(config, device_name, remove=False):
+    if remove:
+        if device_name not in config['blacklist']:
+            return False, f"'{device_name}' is not in blacklist"
+        config['blacklist'].remove(device_name)
+        return True, f"'{device_name}' removed from blacklist"
+    if device_name in config['blacklist']:
+        return False, f"'{device_name}' is already in blacklist"
+    config['blacklist'].append(device_name)
+    return True, f"'{device_name}' added to blacklist"
+
+def mutate_volume(config, volume):
+    config['volume'] = volume
+    return True, f"Volume set to: {volume}%"
+
+def mutate_remove(config, config_type, device_name):
+    if config_type == 'sound':
+        if device_name not in config.get('sound_mappings', {}):
+            return False, f"No sound configured for '{device_name}'"
+        del config['sound_mappings'][device_name]
+        return True, f"Sound for '{device_name}' removed"
+    if config_type == 'action':
+        if device_name not in config.get('device_actions', {}):
+            return False, f"No action configured for '{device_name}'"
+        del config['device_actions'][device_name]
+        return True, f"Action for '{device_name}' removed"
+    if config_type in ['color', 'colour']:
+        if device_name.startswith('vendor:'):
+            vendor_id = device_name.split(':', 1)[1]
+            if vendor_id not in config.get('vendor_colors', {}):
+                return False, f"No color configured for vendor '{vendor_id}'"
+            del config['vendor_colors'][vendor_id]
+            return True, f"Color for vendor '{vendor_id}' removed"
+        if device_name not in config.get('device_colors', {}):
+            return False, f"No color configured for '{device_name}'"
+        del config['device_colors'][device_name]
+        return True, f"Color for '{device_name}' removed"
+    return False, f"Error: Unknown type '{config_type}' (use sound, action or colour)"
+
+# Every config change goes through one of these, either inside the daemon or under the file lock
+CONFIG_MUTATIONS = {
+    'sound': mutate_sound,
+    'color': mutate_color,
+    'action': mutate_action,
+    'blacklist': mutate_blacklist,
+    'volume': mutate_volume,
+    'remove': mutate_remove,
+}
+
+def submit_config_change(op, **args):
+    """Send a config change to the running daemon, or apply it locally under the config lock"""
+    try:
+        message = daemon_request('config.mutate', {'op': op, 'args': args})
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        return
+    if message is None:
+        with config_lock():
+            config = load_config()
+            changed, message = CONFIG_MUTATIONS[op](config, **args)
+            if changed:
+                save_config(config)
+    print(message)
 
 def change_sound(device_name, sound_path, connect=True, disconnect=False):
     """Set sound with new v4.0 syntax"""
-    config = load_config()
-    
     if not os.path.exists(sound_path):
         print(f"Error: Sound file not found: {sound_path}")
         return
-    
-    if device_name not in config['sound_mappings']:
-        config['sound_mappings'][device_name] = {}
-    
-    if connect:
-        config['sound_mappings'][device_name]['connect'] = sound_path
-        print(f"Connect sound for '{device_name}' set to: {sound_path}")
-    
-    if disconnect:
-        config['sound_mappings'][device_name]['disconnect'] = sound_path
-        print(f"Disconnect sound for '{device_name}' set to: {sound_path}")
-    
-    save_config(config)
+    submit_config_change('sound', device_name=device_name, sound_path=sound_path, connect=connect, disconnect=disconnect)
+
+# Where each file of the repository is installed; 'kg manifest' hashes them into manifest.json
+INSTALLED_FILES = {
+    'knocking-goose.py': ('/usr/bin/kg', 0o755),
+    'kg_start.sh': ('/usr/bin/kg_start.sh', 0o755),
+    'kg_start.desktop': ('/etc/xdg/autostart/kg_start.desktop', 0o644),
+    'knocking-goose.service': ('/etc/systemd/system/knocking-goose.service', 0o644),
+    'knocking-goose-icon.png': ('/usr/share/icons/knocking-goose-icon.png', 0o644),
+    'Start.mp3': (SOUND_START, 0o644),
+    'Off.mp3': (SOUND_OFF, 0o644),
+    'Quark.mp3': (SOUND_QUACK, 0o644),
+}
+APT_PACKAGES = ['python3', 'python3-tk', 'python3-gi', 'python3-pyudev', 'gir1.2-gstreamer-1.0', 'gstreamer1.0-plugins-base',
+                'gstreamer1.0-plugins-good', 'gstreamer1.0-plugins-bad', 'gstreamer1.0-plugins-ugly', 'gstreamer1.0-tools']
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def build_manifest(directory='.'):
+    """Write manifest.json for a checkout; run before publishing a release"""
+    files = {}
+    for name, (dest, mode) in INSTALLED_FILES.items():
+        path = os.path.join(directory, name)
+        files[name] = {'sha256': file_sha256(path), 'size': os.path.getsize(path), 'dest': dest, 'mode': f"{mode:o}"}
+    manifest = {'version': VERSION, 'files': files, 'apt': APT_PACKAGES}
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+        f.write('\n')
+    print(f"manifest.json: version {VERSION}, {len(files)} files")
+
+def fetch_manifest(base_url, cache_dir):
+    """Download the manifest unless the cached copy is still current (ETag / Last-Modified)"""
+    cache_file = os.path.join(cache_dir, 'manifest.json')
+    meta_file = os.path.join(cache_dir, 'manifest.meta')
+    meta = {}
+    if os.path.exists(cache_file) and os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+    request = urllib_request.Request(f"{base_url}/manifest.json")
+    if meta.get('etag'):
+        request.add_header('If-None-Match', meta['etag'])
+    if meta.get('last_modified'):
+        request.add_header('If-Modified-Since', meta['last_modified'])
+    try:
+        with urllib_request.urlopen(request, timeout=15) as response:
+            data = response.read()
+            meta = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+    except urllib_request.HTTPError as e:
+        if e.code != 304:
+            raise
+        with open(cache_file) as f:
+            return json.load(f), False
+    manifest = json.loads(data)
+    os.makedirs(cache_dir, exist_ok=True)
+    for path, content in ((cache_file, data), (meta_file, json.dumps(meta).encode())):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(path + '.tmp', path)
+    return manifest, True
+
+def install_file(url, entry):
+    """Download to a temporary file next to the destination, verify it, then swap it in atomically"""
+    dest = entry['dest']
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.kg-update-')
+    try:
+        digest = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as f, urllib_request.urlopen(url, timeout=30) as response:
+            for chunk in iter(lambda: response.read(65536), b''):
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        if digest.hexdigest() != entry['sha256']:
+            raise ValueError(f"checksum mismatch for {url}")
+        os.chmod(tmp_path, int(entry.get('mode', '644'), 8))
+        os.replace(tmp_path, dest)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
 
-def update_knocking_goose():
-    """Run update via kg_start.sh"""
-    print(colorize("Updating Knocking Goose...", Colors.BRIGHT_CYAN))
+def missing_packages(packages):
+    """Packages dpkg does not report as installed; empty means apt can be skipped"""
     try:
-        result = subprocess.run(['sudo', '/usr/bin/kg_start.sh'], check=True, capture_output=True, text=True)
-        print(result.stdout)
-        print(colorize("✓ Update completed successfully!", Colors.BRIGHT_GREEN))
-    except subprocess.CalledProcessError as e:
-        print(colorize(f"✗ Update failed: {e}", Colors.BRIGHT_RED))
-        print(e.stderr)
+        result = subprocess.run(['dpkg-query', '-W', '-f=${Package} ${Status}\n'] + packages,
+                                capture_output=True, text=True)
     except FileNotFoundError:
-        print(colorize("✗ Update script not found at /usr/bin/kg_start.sh", Colors.BRIGHT_RED))
+        return []  # Not a dpkg system; dependencies are the user's business
+    installed = {line.split()[0] for line in result.stdout.splitlines() if line.endswith(' installed')}
+    return [package for package in packages if package not in installed]
+
+@contextmanager
+def update_lock(cache_dir):
+    """One update at a time: every session's kg_start.sh runs 'sudo kg update' at login"""
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, 'update.lock'), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def trusted_files(manifest):
+    """The manifest entries for files this version installs, with the local destination and mode;
+    the updater runs as root, so the manifest must not choose what is written where"""
+    files = {}
+    for name, entry in manifest['files'].items():
+        if name not in INSTALLED_FILES or entry.get('dest') != INSTALLED_FILES[name][0]:
+            print(colorize(f"✗ Ignoring manifest entry {name} -> {entry.get('dest')}: not a Knocking Goose file", Colors.BRIGHT_RED))
+            continue
+        dest, mode = INSTALLED_FILES[name]
+        files[name] = dict(entry, dest=dest, mode=f"{mode:o}")
+    return files
+
+def update_knocking_goose(base_url=UPDATE_URL, cache_dir=UPDATE_CACHE, quiet=False):
+    """Bring the installation up to date with the published manifest, downloading only changed files"""
+    with update_lock(cache_dir):
+        return apply_update(base_url, cache_dir, quiet)
+
+def apply_update(base_url, cache_dir, quiet):
+    say = (lambda *args: None) if quiet else print
+    say(colorize("Checking for updates...", Colors.BRIGHT_CYAN))
+    try:
+        manifest, fresh = fetch_manifest(base_url, cache_dir)
+    except (OSError, ValueError) as e:
+        print(colorize(f"✗ Could not fetch the update manifest: {e}", Colors.BRIGHT_RED))
+        return False
+    if not fresh:
+        say("Manifest unchanged since the last check")
+    
+    files = trusted_files(manifest)
+    stale = {name: entry for name, entry in files.items()
+             if not os.path.exists(entry['dest']) or file_sha256(entry['dest']) != entry['sha256']}
+    # Files and packages a newer release adds are picked up once its kg is installed
+    missing = missing_packages([package for package in manifest.get('apt', []) if package in APT_PACKAGES])
+    if not stale and not missing:
+        say(colorize(f"✓ Knocking Goose {manifest.get('version', VERSION)} is up to date", Colors.BRIGHT_GREEN))
+        return True
+    if os.geteuid() != 0:
+        print(colorize("✗ Updating needs root: sudo kg update", Colors.BRIGHT_RED))
+        return False
+    
+    if missing:
+        say(f"Installing missing packages: {' '.join(missing)}")
+        install = ['apt-get', 'install', '-y'] + missing
+        if subprocess.run(install).returncode != 0:
+            subprocess.run(['apt-get', 'update'], check=False)
+            if subprocess.run(install).returncode != 0:
+                print(colorize("✗ Package installation failed", Colors.BRIGHT_RED))
+                return False
+    ok = True
+    for name, entry in stale.items():
+        try:
+            install_file(f"{base_url}/{name}", entry)
+            say(colorize(f"  ✓ {name} -> {entry['dest']}", Colors.BRIGHT_GREEN))
+        except (OSError, ValueError) as e:
+            print(colorize(f"  ✗ {name}: {e}", Colors.BRIGHT_RED))
+            ok = False
+    if ok:
+        say(colorize(f"✓ Updated to {manifest.get('version', VERSION)}", Colors.BRIGHT_GREEN))
+    return ok
 
 def download_sounds():
     """Download sound files from GitHub"""
@@ -405,20 +2859,12 @@ def easter_egg_quack():
         print(colorize("\n(Quack sound not found - run: sudo kg download-sounds)", Colors.DIM))
 
 def set_color(device_name, color_name):
-    config = load_config()
     if color_name.lower() not in Colors.get_all_colors():
         print(f"Error: Unknown color '{color_name}'")
         print("\nAvailable colors:")
         show_colors()
         return
-    if device_name.startswith('vendor:'):
-        vendor_id = device_name.split(':', 1)[1]
-        config['vendor_colors'][vendor_id] = color_name.lower()
-        print(f"Color for vendor '{vendor_id}' set to: {colorize(color_name, Colors.get_color(color_name))}")
-    else:
-        config['device_colors'][device_name] = color_name.lower()
-        print(f"Color for '{device_name}' set to: {colorize(color_name, Colors.get_color(color_name))}")
-    save_config(config)
+    submit_config_change('color', device_name=device_name, color_name=color_name)
 
 def show_colors():
     colors = Colors.get_all_colors()
@@ -430,59 +2876,58 @@ def show_colors():
     print("=" * 50 + "\n")
 
 def set_action(device_name, script_path):
-    config = load_config()
     if not os.path.exists(script_path):
         print(f"Error: Script not found: {script_path}")
         return
     if not os.access(script_path, os.X_OK):
         print(f"Warning: Script is not executable: {script_path}")
         print("Run: chmod +x " + script_path)
-    config['device_actions'][device_name] = script_path
-    print(f"Action for '{device_name}' set to: {script_path}")
-    save_config(config)
+    submit_config_change('action', device_name=device_name, script_path=script_path)
 
 def manage_blacklist(device_name, remove=False):
-    config = load_config()
-    if remove:
-        if device_name in config['blacklist']:
-            config['blacklist'].remove(device_name)
-            print(f"'{device_name}' removed from blacklist")
-        else:
-            print(f"'{device_name}' is not in blacklist")
-    else:
-        if device_name not in config['blacklist']:
-            config['blacklist'].append(device_name)
-            print(f"'{device_name}' added to blacklist")
-        else:
-            print(f"'{device_name}' is already in blacklist")
-    save_config(config)
+    submit_config_change('blacklist', device_name=device_name, remove=remove)
 
 def set_volume(volume):
-    config = load_config()
     try:
         vol = int(volume)
-        if vol < 0 or vol > 100:
-            print("Error: Volume must be between 0 and 100")
-            return
-        config['volume'] = vol
-        save_config(config)
-        print(f"Volume set to: {vol}%")
     except ValueError:
         print("Error: Volume must be a number")
+        return
+    if vol < 0 or vol > 100:
+        print("Error: Volume must be between 0 and 100")
+        return
+    submit_config_change('volume', volume=vol)
 
-def list_devices():
+def enumerate_devices():
+    """Connected usb_devices in the same shape as DeviceIndex.list"""
     context = pyudev.Context()
+    return [dict(device_info(device), sys_path=device.sys_path)
+            for device in context.list_devices(subsystem='usb', DEVTYPE='usb_device')]
+
+def list_devices(output_format='text'):
+    # A running daemon already holds the device index; ask it before walking sysfs
+    try:
+        devices = daemon_request('devices.list')
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        return
+    if devices is None:
+        devices = enumerate_devices()
+    if output_format == 'jsonl':
+        for device in devices:
+            write_jsonl(device)
+        return
     config = load_config()
     print("\n" + "=" * 70)
     print(colorize("Currently connected USB devices", Colors.BOLD + Colors.BRIGHT_CYAN))
     print("=" * 70)
     device_count = 0
-    for device in context.list_devices(subsystem='usb'):
-        device_id = device.get('ID_SERIAL', 'default')
-        vendor_id = device.get('ID_VENDOR_ID', 'N/A')
-        product_id = device.get('ID_MODEL_ID', 'N/A')
-        vendor_name = device.get('ID_VENDOR', 'Unknown')
-        model_name = device.get('ID_MODEL', 'Unknown')
+    for device in devices:
+        device_id = device['serial']
+        vendor_id = device['vendor'] or 'N/A'
+        product_id = device['model'] or 'N/A'
+        vendor_name = device['vendor_name'] or 'Unknown'
+        model_name = device['model_name'] or 'Unknown'
         if device_id != 'default':
             device_count += 1
             color = get_device_color(device_id, vendor_id, config)
@@ -493,105 +2938,256 @@ def list_devices():
     print(f"Total devices: {device_count}")
     print("=" * 70 + "\n")
 
-def show_history(days=1):
-    config = load_config()
-    history = config.get('history', [])
+def recent_events(days=1):
+    """History events of the last days, oldest first"""
+    cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+    return list(get_event_log().events(since=cutoff))
+
+def stats_since(days):
+    return (datetime.now() - timedelta(days=days)).isoformat() if days else None
+
+def compute_stats(days=None, top=None):
+    """Connect/disconnect counts per device, read from the pre-aggregated totals"""
+    return get_event_log().device_stats(stats_since(days), top)
+
+def compute_sessions(days=None):
+    """Connected time per device from paired add/remove events, in one streaming pass"""
+    sessions = {}
+    for event in get_event_log().stream(stats_since(days)):
+        entry = sessions.setdefault(event['device'], {'sessions': 0, 'total': 0.0, 'longest': 0.0, 'since': None})
+        event_time = datetime.fromisoformat(event['timestamp'])
+        if event['action'] == 'add':
+            entry['since'] = event_time
+        elif entry['since'] is not None:
+            duration = (event_time - entry['since']).total_seconds()
+            entry['sessions'] += 1
+            entry['total'] += duration
+            entry['longest'] = max(entry['longest'], duration)
+            entry['since'] = None
+    return sessions
+
+def detect_flaps(count=3, seconds=60, days=None):
+    """Devices that reconnected count times within seconds, e.g. a flaky cable or failing hub"""
+    recent = {}  # device -> deque of recent connect times
+    flaps = {}
+    for event in get_event_log().stream(stats_since(days)):
+        if event['action'] != 'add':
+            continue
+        event_time = datetime.fromisoformat(event['timestamp'])
+        times = recent.setdefault(event['device'], deque())
+        times.append(event_time)
+        while (event_time - times[0]).total_seconds() > seconds:
+            times.popleft()
+        if len(times) >= count:
+            entry = flaps.setdefault(event['device'], {'flaps': 0, 'last': None, 'vendor': event['vendor'] or 'N/A'})
+            entry['flaps'] += 1
+            entry['last'] = event['timestamp']
+            times.clear()  # Count each burst once
+    return flaps
+
+def compute_report(days=None, top=None, sessions=False, flaps=None, vendors=False):
+    """Every section 'kg stats' shows, read from one history database"""
+    report = {'devices': compute_stats(days, top)}
+    if vendors:
+        report['vendors'] = get_event_log().vendor_stats(stats_since(days), top)
+    if sessions:
+        report['sessions'] = {device: {key: entry[key] for key in ('sessions', 'total', 'longest')}
+                              for device, entry in compute_sessions(days).items()}
+    if flaps:
+        report['flaps'] = detect_flaps(flaps[0], flaps[1], days)
+    return report
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60}m"
+
+def show_history(days=1, output_format='text'):
+    try:
+        history = daemon_request('history', {'days': days})
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        return
+    if history is None:
+        history = recent_events(days)
+    if output_format == 'jsonl':
+        for event in history:
+            write_jsonl(event)
+        return
     if not history:
         print("No history available")
         return
-    cutoff = datetime.now() - timedelta(days=days)
+    config = load_config()
     print("\n" + "=" * 80)
     print(colorize(f"USB Device History (last {days} day{'s' if days > 1 else ''})", Colors.BOLD + Colors.BRIGHT_CYAN))
     print("=" * 80)
     for event in reversed(history):
         event_time = datetime.fromisoformat(event['timestamp'])
-        if event_time >= cutoff:
-            time_str = event_time.strftime("%Y-%m-%d %H:%M:%S")
-            device_str = event['device']
-            vendor_id = event.get('vendor', 'N/A')
-            color = get_device_color(device_str, vendor_id, config)
-            if event['action'] == 'add':
-                symbol = colorize("●", Colors.BRIGHT_GREEN)
-                action_str = colorize("CONNECTED   ", Colors.BRIGHT_GREEN)
-            else:
-                symbol = colorize("○", Colors.DIM + Colors.RED)
-                action_str = colorize("DISCONNECTED", Colors.RED)
-            vendor_str = f" (Vendor: {colorize(vendor_id, Colors.CYAN)})" if vendor_id != 'N/A' else ""
-            print(f"{symbol} {time_str} | {action_str} | {colorize(device_str, color)}{vendor_str}")
+        time_str = event_time.strftime("%Y-%m-%d %H:%M:%S")
+        device_str = event['device']
+        vendor_id = event.get('vendor', 'N/A')
+        color = get_device_color(device_str, vendor_id, config)
+        if event['action'] == 'add':
+            symbol = colorize("●", Colors.BRIGHT_GREEN)
+            action_str = colorize("CONNECTED   ", Colors.BRIGHT_GREEN)
+        else:
+            symbol = colorize("○", Colors.DIM + Colors.RED)
+            action_str = colorize("DISCONNECTED", Colors.RED)
+        vendor_str = f" (Vendor: {colorize(vendor_id, Colors.CYAN)})" if vendor_id != 'N/A' else ""
+        print(f"{symbol} {time_str} | {action_str} | {colorize(device_str, color)}{vendor_str}")
     print("=" * 80 + "\n")
 
-def show_stats():
-    config = load_config()
-    history = config.get('history', [])
-    if not history:
-        print("No statistics available")
+def show_actions(days=1, output_format='text'):
+    results = get_user_log().actions(stats_since(days))
+    if output_format == 'jsonl':
+        for result in results:
+            write_jsonl(result)
         return
-    stats = {}
-    vendor_map = {}
-    for event in history:
-        device = event['device']
-        action = event['action']
-        vendor = event.get('vendor', 'N/A')
-        if device not in stats:
-            stats[device] = {'connects': 0, 'disconnects': 0}
-            vendor_map[device] = vendor
-        if action == 'add':
-            stats[device]['connects'] += 1
+    if not results:
+        print("No actions have run")
+        return
+    print("\n" + "=" * 80)
+    print(colorize(f"Action Scripts (last {days} day{'s' if days > 1 else ''})", Colors.BOLD + Colors.BRIGHT_CYAN))
+    print("=" * 80)
+    for result in reversed(results):
+        time_str = datetime.fromisoformat(result['timestamp']).strftime("%Y-%m-%d %H:%M:%S")
+        if result['timed_out']:
+            status = colorize("TIMEOUT", Colors.YELLOW)
+        elif result['exit_code'] == 0:
+            status = colorize("OK     ", Colors.BRIGHT_GREEN)
         else:
-            stats[device]['disconnects'] += 1
+            status = colorize(f"EXIT {result['exit_code'] if result['exit_code'] is not None else '-':<2}", Colors.RED)
+        print(f"{time_str} | {status} | {result['duration']:.2f}s | {result['device']} -> {result['script']}")
+        for line in result['output'].strip().splitlines()[-5:]:
+            print(colorize(f"    {line}", Colors.DIM))
+    print("=" * 80 + "\n")
+
+def show_stats(days=None, top=None, sessions=False, flaps=None, vendors=False, output_format='text'):
+    # The running monitor answers every section, so a client never mixes the system history with its own
+    params = {'days': days, 'top': top, 'sessions': sessions, 'flaps': flaps, 'vendors': vendors}
+    try:
+        report = daemon_request('stats', params)
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        return
+    if report is None:
+        report = compute_report(**params)
+    stats = report['devices']
+    if output_format == 'jsonl':
+        for device, counts in stats.items():
+            write_jsonl(dict(counts, type='device', device=device))
+        if vendors:
+            for vendor_id, counts in report['vendors'].items():
+                write_jsonl(dict(counts, type='vendor', vendor=vendor_id))
+        if sessions:
+            for device, entry in report['sessions'].items():
+                if entry['sessions']:
+                    write_jsonl({'type': 'sessions', 'device': device, 'sessions': entry['sessions'],
+                                 'total': entry['total'], 'longest': entry['longest']})
+        if flaps:
+            for device, entry in report['flaps'].items():
+                write_jsonl(dict(entry, type='flaps', device=device))
+        return
+    if not stats:
+        print("No statistics available")
+        return
+    config = load_config()
+    window = f" (last {days} day{'s' if days > 1 else ''})" if days else ""
     print("\n" + "=" * 90)
-    print(colorize("USB Device Statistics", Colors.BOLD + Colors.BRIGHT_CYAN))
+    print(colorize(f"USB Device Statistics{window}", Colors.BOLD + Colors.BRIGHT_CYAN))
     print("=" * 90)
     print(f"{'Device':<40} {'Connects':<15} {'Disconnects':<15} {'Vendor':<10}")
     print("-" * 90)
     for device, counts in sorted(stats.items(), key=lambda x: x[1]['connects'], reverse=True):
-        vendor_id = vendor_map.get(device, 'N/A')
+        vendor_id = counts['vendor']
         color = get_device_color(device, vendor_id, config)
         connects_str = colorize(str(counts['connects']), Colors.BRIGHT_GREEN)
         disconnects_str = colorize(str(counts['disconnects']), Colors.RED)
         vendor_str = colorize(vendor_id if vendor_id != 'N/A' else '-', Colors.CYAN)
         print(f"{colorize(device, color):<49} {connects_str:<24} {disconnects_str:<24} {vendor_str:<19}")
+    
+    if vendors:
+        print("\n" + colorize("By vendor", Colors.BOLD))
+        print("-" * 90)
+        print(f"{'Vendor':<40} {'Connects':<15} {'Disconnects':<15}")
+        for vendor_id, counts in report['vendors'].items():
+            print(f"{colorize(vendor_id, Colors.CYAN):<49} {colorize(str(counts['connects']), Colors.BRIGHT_GREEN):<24} "
+                  f"{colorize(str(counts['disconnects']), Colors.RED):<24}")
+    
+    if sessions:
+        print("\n" + colorize("Connected sessions", Colors.BOLD))
+        print("-" * 90)
+        print(f"{'Device':<40} {'Sessions':<10} {'Average':<12} {'Longest':<12} {'Total':<12}")
+        rows = sorted(((device, entry) for device, entry in report['sessions'].items() if entry['sessions']),
+                      key=lambda x: x[1]['total'], reverse=True)
+        for device, entry in rows[:top] if top else rows:
+            color = get_device_color(device, None, config)
+            print(f"{colorize(device, color):<49} {entry['sessions']:<10} {format_duration(entry['total'] / entry['sessions']):<12} "
+                  f"{format_duration(entry['longest']):<12} {format_duration(entry['total']):<12}")
+    
+    if flaps:
+        count, seconds = flaps
+        print("\n" + colorize(f"Flapping devices ({count}+ reconnects within {seconds}s)", Colors.BOLD + Colors.BRIGHT_RED))
+        print("-" * 90)
+        rows = sorted(report['flaps'].items(), key=lambda x: x[1]['flaps'], reverse=True)
+        if not rows:
+            print("None")
+        for device, entry in rows[:top] if top else rows:
+            color = get_device_color(device, entry['vendor'], config)
+            last = datetime.fromisoformat(entry['last']).strftime("%Y-%m-%d %H:%M:%S")
+            print(f"{colorize(device, color):<49} {entry['flaps']:<4} bursts, last {last}")
     print("=" * 90 + "\n")
 
+def show_metrics(output_format='text', prometheus=False):
+    try:
+        metrics = daemon_request('metrics', {'prometheus': prometheus})
+    except RuntimeError as e:
+        print(f"Error: {e}")
+        return False
+    if metrics is None:
+        print("Error: Knocking Goose is not running")
+        return False
+    if not metrics['enabled']:
+        print("Metrics are disabled; start the monitor with --metrics or set \"metrics\": true in the config")
+        return False
+    if prometheus:
+        # The same text the metrics_port endpoint serves, e.g. for node_exporter's textfile collector
+        print(metrics['text'], end='')
+        return True
+    if output_format == 'jsonl':
+        write_jsonl(metrics)
+        return True
+    print("\n" + "=" * 80)
+    print(colorize(f"Monitor Metrics (up {format_duration(metrics['uptime'])})", Colors.BOLD + Colors.BRIGHT_CYAN))
+    print("=" * 80)
+    print(f"{'Stage':<16} {'Count':>10} {'Mean ms':>10} {'p50 ms':>10} {'p99 ms':>10} {'Max ms':>10}")
+    print("-" * 80)
+    for stage, entry in metrics['stages'].items():
+        if entry['count']:
+            print(f"{stage:<16} {entry['count']:>10} {entry['mean'] * 1000:>10.3f} {entry['p50'] * 1000:>10.3f} "
+                  f"{entry['p99'] * 1000:>10.3f} {entry['max'] * 1000:>10.3f}")
+    print("\n" + colorize("Counters", Colors.BOLD))
+    print("-" * 80)
+    for name, value in metrics['counters'].items():
+        print(f"{name.replace('_', ' '):<30} {value:>10}")
+    print("\n" + colorize("Queues", Colors.BOLD))
+    print("-" * 80)
+    for name, stats in metrics['queues'].items():
+        print(f"{name:<16} depth {stats['depth']:<6} max {stats['max_depth']:<6} dropped {stats['dropped']}")
+    print("=" * 80 + "\n")
+    return True
+
 def remove_config(config_type, device_name):
-    config = load_config()
-    if config_type == 'sound':
-        if device_name in config.get('sound_mappings', {}):
-            del config['sound_mappings'][device_name]
-            print(f"Sound for '{device_name}' removed")
-        else:
-            print(f"No sound configured for '{device_name}'")
-            return
-    elif config_type == 'action':
-        if device_name in config.get('device_actions', {}):
-            del config['device_actions'][device_name]
-            print(f"Action for '{device_name}' removed")
-        else:
-            print(f"No action configured for '{device_name}'")
-            return
-    elif config_type in ['color', 'colour']:
-        if device_name.startswith('vendor:'):
-            vendor_id = device_name.split(':', 1)[1]
-            if vendor_id in config.get('vendor_colors', {}):
-                del config['vendor_colors'][vendor_id]
-                print(f"Color for vendor '{vendor_id}' removed")
-            else:
-                print(f"No color configured for vendor '{vendor_id}'")
-                return
-        else:
-            if device_name in config.get('device_colors', {}):
-                del config['device_colors'][device_name]
-                print(f"Color for '{device_name}' removed")
-            else:
-                print(f"No color configured for '{device_name}'")
-                return
-    save_config(config)
+    submit_config_change('remove', config_type=config_type, device_name=device_name)
 
 def show_version():
     print("=" * 70)
     print(colorize("Knocking Goose - USB Device Sound Notifier", Colors.BOLD + Colors.BRIGHT_CYAN))
     print("=" * 70)
-    print(f"\n{colorize('Current Version:', Colors.BOLD)} {colorize('4.0', Colors.BRIGHT_GREEN)}")
+    print(f"\n{colorize('Current Version:', Colors.BOLD)} {colorize(VERSION, Colors.BRIGHT_GREEN)}")
     print(f"{colorize('Release Date:', Colors.BOLD)} 2025-12-22 03:00")
     print("\n" + "=" * 70)
     print(colorize("VERSION HISTORY", Colors.BOLD + Colors.BRIGHT_YELLOW))
@@ -630,14 +3226,29 @@ def test_sound(device_name, event_type='connect'):
     sound_file = find_matching_sound(device_name, vendor_id, event_type, config)
     if sound_file:
         print(f"Playing {event_type} sound: {sound_file}")
-        play_sound(sound_file, config.get('volume', 100))
+        cache = SoundCache(config.get('sound_cache_mb', 32) * 1024 * 1024)
+        start = time.perf_counter()
+        pcm, _ = cache.get(sound_file)
+        decode_time = time.perf_counter() - start
+        if pcm is None:
+            print(colorize("  Cache: not decodable, falling back to playbin", Colors.YELLOW))
+            play_sound(sound_file, config.get('volume', 100))
+            return
+        print(f"  Cache miss: decoded in {decode_time * 1000:.1f} ms")
+        # Replay through the warm cache to show what the monitor sees on later plugs
+        start = time.perf_counter()
+        pcm, hit = cache.get(sound_file)
+        lookup_time = time.perf_counter() - start
+        first_sample = play_pcm(make_pcm_pipeline(), pcm, config.get('volume', 100))
+        if first_sample is None:
+            return
+        print(f"  Cache {'hit' if hit else 'miss'}: first sample after {(lookup_time + first_sample) * 1000:.1f} ms")
     else:
         print(f"No {event_type} sound configured for {device_name}")
 
 def main():
-    global debug_mode
     parser = argparse.ArgumentParser(
-        description='Knocking Goose v4.0 - USB Device Sound Notifier',
+        description=f'Knocking Goose v{VERSION} - USB Device Sound Notifier',
         epilog=f"{colorize('Examples:', Colors.BOLD)}\n"
                f"  kg change-sound -connect -disconnect device /sound.mp3\n"
                f"  kg change-sound -disconnect /sounds/disconnect.wav\n"
@@ -656,10 +3267,34 @@ def main():
     parser.add_argument('-default', '--hide-default', action='store_true')
     parser.add_argument('-device', '--hide-devices', action='store_true')
     parser.add_argument('-all', '--show-all', action='store_true')
+    parser.add_argument('--interfaces', action='store_true', help='Also receive usb_interface events')
+    parser.add_argument('--system', action='store_true', help='Run the one system-wide monitor for all sessions (as root)')
+    parser.add_argument('--client', action='store_true', help='Announce the events of the system-wide monitor for this session')
+    parser.add_argument('--quiet', action='store_true', help='update: only report problems')
+    parser.add_argument('--metrics', action='store_true', help='Time every monitor stage for kg metrics')
+    parser.add_argument('--format', choices=['text', 'jsonl'], default='text', help='Output format of the monitor, list, history, actions and stats')
+    parser.add_argument('--top', type=int, help='stats: only show the N busiest entries')
+    parser.add_argument('--sessions', action='store_true', help='stats: show connected session durations')
+    parser.add_argument('--flaps', metavar='COUNT/SECONDS', help='stats: show devices reconnecting COUNT times within SECONDS')
+    parser.add_argument('--vendors', action='store_true', help='stats: show totals per vendor')
+    parser.add_argument('--profile', action='store_true', help='Profile the monitor or command; SIGUSR1 writes the profile so far')
+    parser.add_argument('--profiler', choices=['cprofile', 'sample'], default='cprofile',
+                        help='cprofile writes pstats, sample writes collapsed stacks of all threads')
+    parser.add_argument('--profile-out', metavar='FILE', help='Where to write the profile (default kg-COMMAND.prof or .folded)')
+    parser.add_argument('--tracemalloc', action='store_true', help='With --profile, also snapshot allocations')
     parser.add_argument('command', nargs='?')
     parser.add_argument('args', nargs='*')
     args = parser.parse_args()
     
+    if args.profile:
+        path = args.profile_out or f"kg-{args.command or 'monitor'}.{'folded' if args.profiler == 'sample' else 'prof'}"
+        with profiling(os.path.abspath(path), args.profiler, args.tracemalloc):
+            run_command(args)
+    else:
+        run_command(args)
+
+def run_command(args):
+    global debug_mode, HISTORY_DB
     if args.debug:
         debug_mode = True
         print(colorize("DEBUG MODE ENABLED", Colors.BRIGHT_YELLOW))
@@ -673,6 +3308,10 @@ def main():
         show_version()
         return
     
+    if args.system or args.client:
+        # History is kept once, by the system monitor
+        HISTORY_DB = SYSTEM_HISTORY_DB
+    
     # Parse -connect and -disconnect flags
     connect_flag = '-connect' in args.args
     disconnect_flag = '-disconnect' in args.args
@@ -692,7 +3331,10 @@ def main():
             connect_flag = True
         change_sound(device_name, sound_path, connect_flag, disconnect_flag)
     elif args.command == 'update':
-        update_knocking_goose()
+        if not update_knocking_goose(quiet=args.quiet):
+            sys.exit(1)
+    elif args.command == 'manifest':
+        build_manifest(filtered_args[0] if filtered_args else '.')
     elif args.command == 'quack':
         easter_egg_quack()
     elif args.command == 'download-sounds':
@@ -718,21 +3360,87 @@ def main():
         manage_blacklist(device_name, remove)
     elif args.command == 'volume':
         if len(filtered_args) < 1:
-            print("Error: volume requires NUMBER")
+            try:
+                volume = daemon_request('volume')
+            except RuntimeError as e:
+                print(f"Error: {e}")
+                sys.exit(1)
+            print(f"Volume: {load_config().get('volume', 100) if volume is None else volume}%")
+        else:
+            set_volume(filtered_args[0])
+    elif args.command in ['mute', 'unmute', 'reload']:
+        params = {'muted': args.command == 'mute'} if args.command != 'reload' else {}
+        try:
+            message = daemon_request('reload' if args.command == 'reload' else 'mute', params)
+        except RuntimeError as e:
+            print(f"Error: {e}")
             sys.exit(1)
-        set_volume(filtered_args[0])
+        if message is None:
+            print("Error: Knocking Goose is not running")
+            sys.exit(1)
+        print(message)
     elif args.command == 'list':
-        list_devices()
+        list_devices(args.format)
     elif args.command == 'history':
         days = int(filtered_args[0]) if filtered_args else 1
-        show_history(days)
+        show_history(days, args.format)
+    elif args.command == 'actions':
+        days = int(filtered_args[0]) if filtered_args else 1
+        show_actions(days, args.format)
     elif args.command == 'stats':
-        show_stats()
+        days = int(filtered_args[0]) if filtered_args else None
+        flaps = None
+        if args.flaps:
+            try:
+                count, seconds = args.flaps.split('/')
+                flaps = (int(count), float(seconds))
+            except ValueError:
+                print("Error: --flaps expects COUNT/SECONDS, e.g. --flaps 3/60")
+                sys.exit(1)
+        show_stats(days, args.top, args.sessions, flaps, args.vendors, args.format)
+    elif args.command == 'metrics':
+        if not show_metrics(args.format, 'prometheus' in filtered_args):
+            sys.exit(1)
     elif args.command == 'remove':
         if len(filtered_args) < 2:
             print("Error: remove requires TYPE and DEVICE")
             sys.exit(1)
         remove_config(filtered_args[0], filtered_args[1])
+    elif args.command == 'record':
+        if len(filtered_args) < 1:
+            print("Error: record requires FILE")
+            sys.exit(1)
+        record_trace(filtered_args[0])
+    elif args.command == 'replay':
+        if len(filtered_args) < 1:
+            print("Error: replay requires FILE [SPEED]")
+            sys.exit(1)
+        event_stream = None
+        if args.format == 'jsonl':
+            event_stream = sys.stdout
+            sys.stdout = sys.stderr
+        speed = float(filtered_args[1]) if len(filtered_args) > 1 else 1.0
+        replay_trace(filtered_args[0], speed, args.hide_connects, args.hide_disconnects, args.hide_default, args.hide_devices,
+                     args.show_all, args.interfaces, event_stream)
+    elif args.command == 'bench':
+        target = filtered_args[0] if filtered_args else None
+        if target == 'rules':
+            rule_count = int(filtered_args[1]) if len(filtered_args) > 1 else 10000
+            event_count = int(filtered_args[2]) if len(filtered_args) > 2 else 100000
+            benchmark_rules(rule_count, event_count)
+        elif target == 'pipeline':
+            plug_count = int(filtered_args[1]) if len(filtered_args) > 1 else 5000
+            rule_count = int(filtered_args[2]) if len(filtered_args) > 2 else 1000
+            benchmark_pipeline(None, rule_count, plug_count)
+        elif target == 'replay' and len(filtered_args) > 1:
+            benchmark_pipeline(read_trace(filtered_args[1]))
+        elif target == 'startup':
+            budget = float(filtered_args[1]) if len(filtered_args) > 1 else STARTUP_BUDGET_MS
+            if not benchmark_startup(budget):
+                sys.exit(1)
+        else:
+            print("Error: bench requires a target: rules [RULES] [EVENTS] | pipeline [PLUGS] [RULES] | replay TRACE | startup [BUDGET_MS]")
+            sys.exit(1)
     elif args.command == 'test-sound':
         if len(filtered_args) < 1:
             print("Error: test-sound requires DEVICE")
@@ -743,25 +3451,33 @@ def main():
         print(f"Error: Unknown command '{args.command}'")
         sys.exit(1)
     else:
-        # Play startup sound
-        if os.path.exists(SOUND_START):
+        event_stream = None
+        if args.format == 'jsonl':
+            # stdout carries only the events; everything meant for people goes to stderr
+            event_stream = sys.stdout
+            sys.stdout = sys.stderr
+        # Play startup sound; the system monitor has no session to play it in
+        if not args.system and os.path.exists(SOUND_START):
             play_sound(SOUND_START, load_config().get('volume', 100))
         
-        print(colorize("Starting Knocking Goose v4.0...", Colors.BRIGHT_CYAN))
+        print(colorize(f"Starting Knocking Goose v{VERSION}...", Colors.BRIGHT_CYAN))
         config = load_config()
         print(f"Volume: {config.get('volume', 100)}%")
-        monitor_thread = threading.Thread(target=monitor_usb, args=(args.hide_connects, args.hide_disconnects, args.hide_default, args.hide_devices, args.show_all))
-        monitor_thread.daemon = True
-        monitor_thread.start()
+        role = 'system' if args.system else 'client' if args.client else 'local'
+        daemon = MonitorDaemon(args.hide_connects, args.hide_disconnects, args.hide_default, args.hide_devices, args.show_all, args.interfaces, event_stream,
+                               role=role, metrics=args.metrics)
         print(colorize("Knocking Goose is running!", Colors.BRIGHT_GREEN))
         print("Press Ctrl+C to stop.")
         try:
-            while True:
-                time.sleep(1)
-        except KeyboardInterrupt:
+            asyncio.run(daemon.run())
+        except (KeyboardInterrupt, asyncio.CancelledError):
             print(colorize("\nStopping Knocking Goose...", Colors.BRIGHT_YELLOW))
+            print(f"Suppressed duplicate events: {deduplicator.suppressed}")
+            for name, stats in daemon.stats().items():
+                if stats['dropped']:
+                    print(f"Dropped from {name} queue: {stats['dropped']} (max depth {stats['max_depth']})")
             # Play shutdown sound
-            if os.path.exists(SOUND_OFF):
+            if not args.system and os.path.exists(SOUND_OFF):
                 play_sound(SOUND_OFF, config.get('volume', 100))
 
 if __name__ == '__main__':
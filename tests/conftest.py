@@ -0,0 +1,14 @@
+import importlib.util
+import os
+
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'knocking-goose.py')
+
+@pytest.fixture(scope='session')
+def kg():
+    """knocking-goose.py loaded as a module; GStreamer and pyudev stay unloaded until used"""
+    spec = importlib.util.spec_from_file_location('knocking_goose', SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
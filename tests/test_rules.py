@@ -0,0 +1,91 @@
+import fnmatch
+import random
+
+def resolve(kg, rules, device_id, vendor_id=None):
+    return kg.RuleResolver(rules).match(device_id, vendor_id)
+
+def test_exact_device_beats_patterns(kg):
+    rules = {'*': 'any', 'Logi*': 'pattern', 'vendor:046d': 'vendor', 'Logitech_USB_Receiver': 'exact'}
+    assert resolve(kg, rules, 'Logitech_USB_Receiver', '046d') == 'exact'
+    assert resolve(kg, rules, 'Logitech_Mouse', '046d') == 'pattern'
+    assert resolve(kg, rules, 'Mouse', '046d') == 'vendor'
+    assert resolve(kg, rules, 'Mouse', '1234') == 'any'
+    assert resolve(kg, rules, 'Mouse') == 'any'
+
+def test_more_specific_wildcard_wins(kg):
+    rules = {'Logi*': 'short', 'Logitech_*': 'long', '*_Receiver': 'suffix'}
+    assert resolve(kg, rules, 'Logitech_USB_Receiver') == 'long'
+    assert resolve(kg, rules, 'Logi_Receiver') == 'suffix'
+    assert resolve(kg, rules, 'Logi') == 'short'
+
+def test_vendor_precedence(kg):
+    rules = {'vendor:046d': 'exact', 'vendor:04*': 'pattern', 'vendor:0*': 'broad'}
+    assert resolve(kg, rules, 'Mouse', '046d') == 'exact'
+    assert resolve(kg, rules, 'Mouse', '04f3') == 'pattern'
+    assert resolve(kg, rules, 'Mouse', '0b05') == 'broad'
+    assert resolve(kg, rules, 'Mouse', '1532') is None
+    assert resolve(kg, rules, 'Mouse') is None
+
+def test_vendor_pattern_matches_longer_vendor_id(kg):
+    # Regression: 'vendor:153*' must match Razer's 1532
+    assert resolve(kg, {'vendor:153*': 'razer'}, 'Razer_Mouse', '1532') == 'razer'
+    assert resolve(kg, {'vendor:153*': 'razer', 'vendor:1532': 'exact'}, 'Razer_Mouse', '1532') == 'exact'
+    assert resolve(kg, {'vendor:153*': 'razer', '*': 'any'}, 'Razer_Mouse', '1533') == 'razer'
+    assert resolve(kg, {'vendor:153*': 'razer', '*': 'any'}, 'Razer_Mouse', '1632') == 'any'
+
+def test_blacklist_and_sounds_from_config(kg):
+    config = {'blacklist': ['vendor:153*'],
+              'sound_mappings': {'Kbd': {'connect': '/kbd.mp3'}, '*': {'connect': '/any.mp3', 'disconnect': '/off.mp3'}}}
+    assert kg.is_blacklisted('Razer_Mouse', '1532', config)
+    assert not kg.is_blacklisted('Kbd', '046d', config)
+    assert kg.find_matching_sound('Kbd', '046d', 'connect', config) == '/kbd.mp3'
+    assert kg.find_matching_sound('Kbd', '046d', 'disconnect', config) == '/off.mp3'
+    assert kg.find_matching_sound('Mouse', None, 'connect', config) == '/any.mp3'
+
+def specificity(pattern):
+    return len(pattern) - pattern.count('*')
+
+def top_candidates(rules, device_id, vendor_id):
+    """Values the resolver may return: the most specific matches of the first tier that has any"""
+    tiers = [
+        [p for p in rules if p == device_id],
+        [p for p in rules if not p.startswith('vendor:') and p != '*' and '*' in p and fnmatch.fnmatchcase(device_id, p)],
+        [p for p in rules if vendor_id and p == f"vendor:{vendor_id}"],
+        [p for p in rules if vendor_id and p.startswith('vendor:') and '*' in p and fnmatch.fnmatchcase(vendor_id, p[len('vendor:'):])],
+        [p for p in rules if p == '*'],
+    ]
+    for tier in tiers:
+        if tier:
+            best = max(specificity(p) for p in tier)
+            return {rules[p] for p in tier if specificity(p) == best}
+    return {None}
+
+def random_pattern(rng, text):
+    start = rng.randrange(len(text))
+    end = rng.randrange(start, len(text) + 1)
+    return (text[:start] + '*' + text[end:]) if rng.random() < 0.8 else text[:start] + '*'
+
+def test_resolver_returns_a_top_specificity_candidate(kg):
+    rng = random.Random(6)
+    alphabet = 'ab1_'
+    for _ in range(2000):
+        devices = [''.join(rng.choice(alphabet) for _ in range(rng.randint(1, 6))) for _ in range(4)]
+        vendors = [''.join(rng.choice('12') for _ in range(4)) for _ in range(3)]
+        rules = {}
+        for value in range(rng.randint(1, 8)):
+            kind = rng.random()
+            if kind < 0.3:
+                pattern = rng.choice(devices)
+            elif kind < 0.6:
+                pattern = random_pattern(rng, rng.choice(devices))
+            elif kind < 0.75:
+                pattern = f"vendor:{rng.choice(vendors)}"
+            elif kind < 0.95:
+                pattern = f"vendor:{random_pattern(rng, rng.choice(vendors))}"
+            else:
+                pattern = '*'
+            rules[pattern] = value
+        resolver = kg.RuleResolver(rules)
+        for device_id in devices:
+            for vendor_id in vendors + [None]:
+                assert resolver.match(device_id, vendor_id) in top_candidates(rules, device_id, vendor_id), (rules, device_id, vendor_id)
@@ -0,0 +1,10 @@
+import pytest
+
+@pytest.mark.parametrize('command', [['--version'], ['colours']], ids=' '.join)
+def test_light_commands_stay_within_import_budget(kg, command, tmp_path, monkeypatch):
+    # The same -X importtime run as 'kg bench startup'; wall time is left to the benchmark,
+    # it depends too much on the machine for a test
+    monkeypatch.setenv('HOME', str(tmp_path))
+    _, imports, loaded = kg.profile_startup(command, runs=1)
+    assert not kg.STARTUP_HEAVY & loaded
+    assert imports <= kg.STARTUP_BUDGET_MS